@@ -2,6 +2,10 @@
     NI DAQmx Documentation: https://documentation.help/NI-DAQmx-C-Functions/
     PyDAQmx  Documentation: https://pythonhosted.org/PyDAQmx/
 '''
+import functools
+import re
+import threading
+
 import numpy as np
 
 try:
@@ -11,6 +15,32 @@ except:
     import FakePyDAQmx as pdmx
 
 
+CHANNEL_RANGE_PATTERN = re.compile(r'a[io](\d+):(\d+)') # matches the "[first channel]:[last channel]" range of an analog channel name
+
+@functools.lru_cache(maxsize=64)
+def count_channels(channel_name):
+    ''' Returns the number of channels in the given analog channel name. Results are cached since tasks are often recreated with the same channels.
+        The channel name is of the form "Dev1/["ai" or "ao"][first channel]:[last channel]".
+    '''
+    match = CHANNEL_RANGE_PATTERN.search(channel_name)
+    if match is None:
+        return 1 # if no last channel is given, there is only one channel being used
+    # if there is a last channel, the number of channels is the difference between the first and last (+1 since it's inclusive)
+    lower, upper = match.groups()
+    return int(upper) - int(lower) + 1
+
+
+# DAQmx constants bound once at import rather than looked up on the module for every call
+GROUP_BY_CHANNEL = pdmx.DAQmx_Val_GroupByChannel
+RISING = pdmx.DAQmx_Val_Rising
+FALLING = pdmx.DAQmx_Val_Falling
+SAMPLE_MODES = {'continuous': pdmx.DAQmx_Val_ContSamps, 'finite': pdmx.DAQmx_Val_FiniteSamps}
+
+# Digital output levels, shared so high()/low() don't build a new array on every call
+DIGITAL_HIGH = np.array([255], dtype=np.uint8)
+DIGITAL_LOW = np.array([0], dtype=np.uint8)
+
+
 
 
 class DigitalOutput:
@@ -38,13 +68,15 @@ class DigitalOutput:
     def write(self, data, samples_per_channel=1, auto_start=1, timeout=10):
         ''' Writes data to the given digital output channel(s). data must be an array of n 8-bit unsigned integers,
             where n is the number of channels and each element of the array is the output for the given channels. 
+            data is converted to a contiguous uint8 array if needed; passing one already avoids the copy.
         '''
+        data = np.ascontiguousarray(data, dtype=np.uint8)
         if self.deviceLoaded:
             self.task.WriteDigitalU8(
                 numSampsPerChan=samples_per_channel,
                 autoStart=auto_start,
                 timeout=timeout,
-                dataLayout=pdmx.DAQmx_Val_GroupByChannel,
+                dataLayout=GROUP_BY_CHANNEL,
                 writeArray=data,
                 reserved=None,
                 sampsPerChanWritten=None
@@ -52,11 +84,11 @@ class DigitalOutput:
 
     def high(self):
         ''' Writes 255 (HIGH) to digital output channel(s). '''
-        self.write(np.array([255], dtype=np.uint8))
+        self.write(DIGITAL_HIGH)
 
     def low(self):
         ''' Writes 0 (LOW) to digital output channel(s). '''
-        self.write(np.array([0], dtype=np.uint8))
+        self.write(DIGITAL_LOW)
 
     def stop(self):
         if self.deviceLoaded:
@@ -87,6 +119,7 @@ class AnalogOutput:
         self.source = source
         self.trigger = trigger
         self.task_started = False
+        self.write_buffer = None # grouped-by-channel buffer reused by write_channels
         self.task = pdmx.Task()
         self.__configure_task()
 
@@ -104,21 +137,29 @@ class AnalogOutput:
             customScaleName=None
         )
 
-        if self.mode == 'continuous':
-            sample_mode = pdmx.DAQmx_Val_ContSamps
-        elif self.mode == 'finite':
-            sample_mode = pdmx.DAQmx_Val_FiniteSamps
+        self.__configure_timing()
+        
+        if self.trigger:
+            self.task.CfgDigEdgeStartTrig(triggerSource=self.trigger, triggerEdge=RISING)
 
+    def __configure_timing(self):
+        ''' Configures the sample clock of the Task object. '''
         self.task.CfgSampClkTiming(
             source=self.source,
             rate=self.clock_rate,
-            activeEdge=pdmx.DAQmx_Val_Rising,
-            sampleMode=sample_mode,
+            activeEdge=RISING,
+            sampleMode=SAMPLE_MODES[self.mode],
             sampsPerChan=self.samples_per_channel
         )
-        
-        if self.trigger:
-            self.task.CfgDigEdgeStartTrig(triggerSource=self.trigger, triggerEdge=pdmx.DAQmx_Val_Rising)
+
+    def reconfigure(self, samples_per_channel=None, clock_rate=None):
+        ''' Changes the samples per channel and/or clock rate of the existing task, stopping it first if it is running.
+            Much faster than clearing the task and creating a new one since the channels stay configured.
+        '''
+        self.stop()
+        if samples_per_channel: self.samples_per_channel = int(samples_per_channel)
+        if clock_rate: self.clock_rate = int(clock_rate)
+        self.__configure_timing()
 
     def write(self, data, samples_per_channel=None, auto_start=False, timeout=10.):
         ''' Writes analog output data to channels. Data should be grouped by channel. 
@@ -128,9 +169,12 @@ class AnalogOutput:
                     CH2 = [y1, y2, y3, ..., yn]
                 They should be concatenated with np.concatenate((CH1,CH2)) as follows.
                     data = [x1, x2, x3, ..., xn, y1, y2, y3, ..., yn]
+
+            data is converted to a contiguous float64 array if needed; passing one (e.g. a reused buffer) avoids the copy.
         '''
+        data = np.ascontiguousarray(data, dtype=np.float64)
         if not samples_per_channel:
-            samples_per_channel = round(data.size/self.number_of_channels)
+            samples_per_channel = data.size // self.number_of_channels # data is grouped by channel so its size is an exact multiple
         else:
             samples_per_channel = int(samples_per_channel)
         
@@ -138,13 +182,30 @@ class AnalogOutput:
             numSampsPerChan=samples_per_channel,
             autoStart=auto_start,
             timeout=timeout,
-            dataLayout=pdmx.DAQmx_Val_GroupByChannel,
+            dataLayout=GROUP_BY_CHANNEL,
             writeArray=data,
             sampsPerChanWritten=None,
             reserved=None
         )
         self.start()
 
+    def write_channels(self, *channel_data, auto_start=False, timeout=10.):
+        ''' Writes one array per channel without concatenating them. The arrays are copied into a write buffer that is reused 
+            between calls, so repeated writes of the same size allocate nothing.
+            Example:
+                ao.write_channels(CH1, CH2) is equivalent to ao.write(np.concatenate((CH1,CH2)))
+        '''
+        assert len(channel_data) == self.number_of_channels, f'Expected data for {self.number_of_channels} channels.'
+        samples_per_channel = len(channel_data[0])
+        size = self.number_of_channels * samples_per_channel
+        if self.write_buffer is None or self.write_buffer.size != size:
+            self.write_buffer = np.empty(size, dtype=np.float64)
+
+        for channel, data in enumerate(channel_data):
+            self.write_buffer[channel*samples_per_channel:(channel+1)*samples_per_channel] = data
+
+        self.write(self.write_buffer, samples_per_channel, auto_start, timeout)
+
     def start(self):
         ''' Preferred way to start the task. '''
         if not self.task_started:
@@ -175,27 +236,15 @@ class AnalogOutput:
         
         # Determine if analog input or output.
         if 'ai' in channel_name:
-            ch = 'ai'
             raise Exception('Analog input channel cannot be used for analog output.')
-        else:
-            ch = 'ao'
         
-        i = channel_name.find(ch) + 2   # i is the index of the first channel
-        j = channel_name.find(':')      # j is the index of the last channel
-
-        if j == -1:
-            number_of_channels = 1 # if no last channel is given, there is only one channel being used
-        else:
-            # if there is a last channel, the number of channels is the difference between the first and last (+1 since it's inclusive)
-            lower = int(channel_name[i:j])
-            upper = int(channel_name[j+1:])
-            number_of_channels = upper - lower + 1
-        return number_of_channels
+        return count_channels(channel_name)
 
 
 
 
 class AnalogInput:
+
     def __init__(self, channel_name, voltage_min=-10., voltage_max=10., clock_rate=5000000, mode='continuous', samples_per_channel=8192, source=None, trigger=None, offset=1):
         ''' Maximum clock rate is 5 MHz for analog output channels. Samples per channel should be no more than 1/10 clock rate.
         '''
@@ -212,6 +261,16 @@ class AnalogInput:
         self.offset = offset
         self.task_started = False
 
+        # Persistent read buffers [channel, data] reused by every read to avoid reallocating on each call. 
+        # Both are allocated on first use since most tasks only ever use one of read or read_raw.
+        self.read_buffer = None     # float64 buffer for read
+        self.raw_read_buffer = None # int16 buffer for read_raw
+        self.samples_read = pdmx.int32() # out-parameter reused by every read
+
+        # Conversion from raw ADC codes to volts: volts = raw * raw_scale + raw_offset. Read from the driver once the channels are created.
+        self.raw_scale = None
+        self.raw_offset = None
+
         self.task = pdmx.Task()
         self.__configure_task()
 
@@ -228,19 +287,9 @@ class AnalogInput:
             units=pdmx.DAQmx_Val_Volts,
             customScaleName=None
         )
+        self.__read_raw_scaling()
 
-        if self.mode == 'continuous':
-            sample_mode = pdmx.DAQmx_Val_ContSamps
-        elif self.mode == 'finite':
-            sample_mode = pdmx.DAQmx_Val_FiniteSamps
-
-        self.task.CfgSampClkTiming(
-            source=self.source,
-            rate=self.clock_rate,
-            activeEdge=pdmx.DAQmx_Val_Falling,
-            sampleMode=sample_mode,
-            sampsPerChan=self.samples_per_channel
-        )
+        self.__configure_timing()
 
         # Sets read offset in samples. This removes the extra sample that was being read before the analog output started.
         offset = pdmx.int32(self.offset)
@@ -249,8 +298,39 @@ class AnalogInput:
         # print(f'Read offset: {offset}')
         
         if self.trigger:
-            self.task.CfgDigEdgeStartTrig(triggerSource=self.trigger, triggerEdge=pdmx.DAQmx_Val_Rising)
+            self.task.CfgDigEdgeStartTrig(triggerSource=self.trigger, triggerEdge=RISING)
+
+    def __read_raw_scaling(self):
+        ''' Sets raw_scale and raw_offset from the input range and ADC resolution the driver actually configured.
+            DAQmx uses the smallest native (symmetric) gain range containing [voltage_min, voltage_max], so the requested limits 
+            only give the right conversion when they happen to be a native range.
+        '''
+        channel = self.channel_name.split(',')[0].split(':')[0] # every channel is created with the same limits, so the first one stands for all
+        range_high, range_low, resolution = pdmx.float64(), pdmx.float64(), pdmx.float64()
+        pdmx.DAQmxGetAIRngHigh(self.task.taskHandle, channel, pdmx.byref(range_high))
+        pdmx.DAQmxGetAIRngLow(self.task.taskHandle, channel, pdmx.byref(range_low))
+        pdmx.DAQmxGetAIResolution(self.task.taskHandle, channel, pdmx.byref(resolution))
+        self.raw_scale = (range_high.value - range_low.value) / 2**resolution.value
+        self.raw_offset = (range_high.value + range_low.value) / 2
+
+    def __configure_timing(self):
+        ''' Configures the sample clock of the Task object. '''
+        self.task.CfgSampClkTiming(
+            source=self.source,
+            rate=self.clock_rate,
+            activeEdge=FALLING,
+            sampleMode=SAMPLE_MODES[self.mode],
+            sampsPerChan=self.samples_per_channel
+        )
 
+    def reconfigure(self, samples_per_channel=None, clock_rate=None):
+        ''' Changes the samples per channel and/or clock rate of the existing task, stopping it first if it is running.
+            Much faster than clearing the task and creating a new one since the channels stay configured.
+        '''
+        self.stop()
+        if samples_per_channel: self.samples_per_channel = int(samples_per_channel)
+        if clock_rate: self.clock_rate = int(clock_rate)
+        self.__configure_timing()
 
     def read(self, samples_per_channel=None, timeout=10):
         ''' Reads analog input according to the configured task. 
@@ -261,6 +341,7 @@ class AnalogInput:
 
             Returns :
                 read_data: 2D numpy array containing read data separated by channel [channel, data]
+                    The array is a view into a reused buffer and is overwritten by the next read. Copy it to keep it.
         '''
         if not samples_per_channel:
             samples_per_channel = self.samples_per_channel
@@ -269,18 +350,134 @@ class AnalogInput:
 
         self.start()
 
-        read_array = np.zeros((self.number_of_channels*samples_per_channel), dtype=np.float64)
-        self.task.ReadAnalogF64(
+        # Allocate the read buffer on first use, growing it once if more samples are requested than it can hold
+        if self.read_buffer is None or samples_per_channel > self.read_buffer.shape[1]:
+            self.read_buffer = np.empty((self.number_of_channels, samples_per_channel), dtype=np.float64)
+
+        read_array = self.read_buffer.reshape(-1)[:self.number_of_channels*samples_per_channel] # contiguous view, no allocation
+        self.__read_into(read_array, samples_per_channel, timeout)
+        return read_array.reshape(self.number_of_channels, samples_per_channel)
+
+    def read_raw(self, samples_per_channel=None, timeout=10):
+        ''' Reads analog input as raw int16 ADC codes, moving a quarter of the data that read() does.
+            Use scale_raw() to convert the codes to volts once they are needed.
+
+            Returns :
+                read_data: 2D int16 numpy array containing raw read data separated by channel [channel, data]
+                    The array is a view into a reused buffer and is overwritten by the next read. Copy it to keep it.
+        '''
+        if not samples_per_channel:
+            samples_per_channel = self.samples_per_channel
+        else:
+            samples_per_channel = int(samples_per_channel)
+
+        self.start()
+
+        if self.raw_read_buffer is None or samples_per_channel > self.raw_read_buffer.shape[1]:
+            self.raw_read_buffer = np.empty((self.number_of_channels, samples_per_channel), dtype=np.int16)
+
+        read_array = self.raw_read_buffer.reshape(-1)[:self.number_of_channels*samples_per_channel] # contiguous view, no allocation
+        self.task.ReadBinaryI16(
             numSampsPerChan=samples_per_channel,
             timeout=timeout,
-            fillMode=pdmx.DAQmx_Val_GroupByChannel,
+            fillMode=GROUP_BY_CHANNEL,
             readArray=read_array,
-            arraySizeInSamps=self.number_of_channels * samples_per_channel,
+            arraySizeInSamps=read_array.size,
             sampsPerChanRead=None,
             reserved=None
         )
-        return np.split(read_array, self.number_of_channels)
-        # return read_array
+        return read_array.reshape(self.number_of_channels, samples_per_channel)
+
+    def scale_raw(self, raw_data, dtype=np.float64):
+        ''' Converts raw ADC codes returned by read_raw() to volts, returning a new array of type dtype. '''
+        volts = np.multiply(raw_data, dtype(self.raw_scale), dtype=dtype)
+        volts += dtype(self.raw_offset)
+        return volts
+
+    def __read_into(self, read_array, samples_per_channel, timeout=10):
+        ''' Reads samples_per_channel samples per channel into the contiguous float64 array read_array, grouped by channel. 
+            Calls the DAQmx function directly with positional arguments, skipping the Task method and keyword handling on this hot path.
+        '''
+        pdmx.DAQmxReadAnalogF64(
+            self.task.taskHandle,
+            samples_per_channel,            # numSampsPerChan
+            timeout,                        # timeout
+            GROUP_BY_CHANNEL,               # fillMode
+            read_array,                     # readArray
+            read_array.size,                # arraySizeInSamps
+            pdmx.byref(self.samples_read),  # sampsPerChanRead
+            None                            # reserved
+        )
+
+    def __register_every_n_samples_event(self, samples_per_channel, function):
+        ''' Registers function() to be called from a DAQmx thread each time samples_per_channel samples are acquired into the buffer. '''
+        def every_n_samples(task_handle, event_type, number_of_samples, callback_data):
+            function()
+            return 0 # DAQmx expects 0 on success
+
+        self.every_n_samples_callback = pdmx.DAQmxEveryNSamplesEventCallbackPtr(every_n_samples) # keep a reference so it isn't garbage collected
+        self.task.RegisterEveryNSamplesEvent(
+            everyNsamplesEventType=pdmx.DAQmx_Val_Acquired_Into_Buffer,
+            nSamples=int(samples_per_channel),
+            options=0,
+            callbackFunction=self.every_n_samples_callback,
+            callbackData=None
+        )
+
+    def register_callback(self, samples_per_channel, callback):
+        ''' Registers a function to be called from a DAQmx thread each time samples_per_channel samples are acquired into the buffer.
+            The callback receives the read data as returned by read(). Must be called before the task is started.
+
+            Example:
+                ai.register_callback(250, lambda data: q.put(data.copy()))
+                ai.start()
+        '''
+        samples_per_channel = int(samples_per_channel)
+        self.__register_every_n_samples_event(samples_per_channel, lambda: callback(self.read(samples_per_channel)))
+
+    def start_streaming(self, samples_per_channel=None, slots=16):
+        ''' Starts continuously reading chunks of samples_per_channel samples into a ring buffer holding the last slots chunks.
+            Chunks are read from a DAQmx thread as soon as they are acquired and retrieved in order with get_chunk().
+            Memory use is constant: if the consumer falls slots chunks or more behind, the oldest chunks are skipped
+            so the chunk returned is never the one being overwritten next.
+
+            Example:
+                ai.start_streaming(250)
+                data = ai.get_chunk()
+        '''
+        if not samples_per_channel:
+            samples_per_channel = self.samples_per_channel
+        else:
+            samples_per_channel = int(samples_per_channel)
+
+        self.ring_buffer = np.empty((slots, self.number_of_channels, samples_per_channel), dtype=np.float64) # [slot, channel, data]
+        self.write_index = 0 # total chunks written
+        self.read_index = 0  # total chunks retrieved
+        self.chunk_ready = threading.Condition()
+
+        def read_chunk():
+            chunk = self.ring_buffer[self.write_index % slots]
+            self.__read_into(chunk.reshape(-1), samples_per_channel)
+            with self.chunk_ready:
+                self.write_index += 1
+                self.chunk_ready.notify()
+
+        self.__register_every_n_samples_event(samples_per_channel, read_chunk)
+        self.start()
+
+    def get_chunk(self, timeout=10.):
+        ''' Returns the next chunk read by start_streaming() as a 2D numpy array [channel, data], waiting up to timeout seconds for it.
+            The array is a view into the ring buffer and is overwritten once the buffer wraps around. Copy it to keep it.
+        '''
+        with self.chunk_ready:
+            if not self.chunk_ready.wait_for(lambda: self.write_index > self.read_index, timeout):
+                raise TimeoutError('No analog input chunk was acquired before the timeout.')
+            slots = len(self.ring_buffer)
+            # skip chunks that were overwritten, and the oldest slot too since it is the next one the callback writes into
+            self.read_index = max(self.read_index, self.write_index - slots + 1)
+            chunk = self.ring_buffer[self.read_index % slots]
+            self.read_index += 1
+        return chunk
 
     def start(self):
         ''' Preferred way to start the task. '''
@@ -313,23 +510,10 @@ class AnalogInput:
         '''
         
         # Determine if analog input or output.
-        if 'ai' in channel_name:
-            ch = 'ai'
-        else:
-            ch = 'ao'
+        if 'ai' not in channel_name:
             raise Exception('Analog output channel cannot be used for analog input.')
         
-        i = channel_name.find(ch) + 2   # i is the index of the first channel
-        j = channel_name.find(':')      # j is the index of the last channel
-
-        if j == -1:
-            number_of_channels = 1 # if no last channel is given, there is only one channel being used
-        else:
-            # if there is a last channel, the number of channels is the difference between the first and last (+1 since it's inclusive)
-            lower = int(channel_name[i:j])
-            upper = int(channel_name[j+1:])
-            number_of_channels = upper - lower + 1
-        return number_of_channels
+        return count_channels(channel_name)
 
 
 
@@ -385,7 +569,6 @@ if __name__ == '__main__':
         y_axis = utils.sawtooth(y_pixels, samples_per_line, 1)
 
         # data = np.vstack((x_axis,y_axis)).ravel('F')
-        data = np.concatenate((x_axis, y_axis))
 
         plt.figure()
         plt.plot(x_axis)
@@ -395,7 +578,7 @@ if __name__ == '__main__':
         # Finite output sets voltage to galvo for only one frame of imaging
         # ao = AnalogOutput('Dev1/ao0:1', clock_rate=clock_rate, mode='finite', samples_per_channel=samples_per_pixel*x_pixels*y_pixels)
         ao = AnalogOutput('Dev1/ao0:1', clock_rate=clock_rate, mode='continuous', samples_per_channel=1)
-        ao.write(data)
+        ao.write_channels(x_axis, y_axis)
         try:
             # ao.wait(20)
             time.sleep(20)
@@ -440,6 +623,34 @@ if __name__ == '__main__':
 
         print(f'Time: {end_time - start_time}')
 
+    def test_gil_release():
+        ''' Checks that blocking DAQmx reads release the GIL so other Python threads keep running.
+            PyDAQmx loads the driver with ctypes (not PyDLL), which releases the GIL for the duration of each DAQmx call.
+
+            Instructions: Connect function generator output to Dev1/ai3. The counter should keep increasing during the 5 second read.
+        '''
+
+        clock_rate = 100000 # samples per second
+        read_time = 5 # seconds
+        number_of_samples = read_time * clock_rate
+
+        count = 0
+        reading = True
+        def count_while_reading():
+            nonlocal count
+            while reading:
+                count += 1
+
+        ai = AnalogInput('Dev1/ai3', clock_rate=clock_rate, mode='finite', samples_per_channel=number_of_samples)
+        counter_thread = threading.Thread(target=count_while_reading)
+        counter_thread.start()
+        ai.read(samples_per_channel=number_of_samples, timeout=2*read_time)
+        reading = False
+        counter_thread.join()
+        ai.clear()
+
+        print(f'Counter iterations during read: {count}')
+
     def test_sync_io():
         ''' Testing synchonous ananlog output and input. 
 
@@ -450,6 +661,8 @@ if __name__ == '__main__':
         repeats_per_point = 1
         duration = 5 # milliseconds
 
+        number_of_lines = 5
+
         samples_per_line = round(points * repeats_per_point)
         clock_rate = round(1000*samples_per_line/duration)
 
@@ -459,14 +672,15 @@ if __name__ == '__main__':
         ao = AnalogOutput('Dev1/ao0', clock_rate=clock_rate, mode='continuous', samples_per_channel=1, source='/Dev1/ai/SampleClock', trigger='/Dev1/ai/StartTrigger')
         ao.write(write_data)
         
-        read_data = [[] for _ in range(ai.number_of_channels)]
+        read_data = np.zeros((ai.number_of_channels, number_of_lines*samples_per_line)) # [channel, data]
 
         ## For continuous reading mode
-        for i in range(5):
+        # Lines are read by DAQmx into a ring buffer as soon as they are acquired
+        ai.start_streaming(samples_per_line)
+        for i in range(number_of_lines):
             try:
-                data = ai.read(samples_per_channel=samples_per_line)
-                for channel, array in enumerate(data):
-                    read_data[channel].extend(array.tolist())
+                data = ai.get_chunk()
+                read_data[:, i*samples_per_line:(i+1)*samples_per_line] = data
             except KeyboardInterrupt:
                 print('loop terminated')
                 break
@@ -474,8 +688,7 @@ if __name__ == '__main__':
         ### For finite reading mode
         # data = ai.read(samples_per_channel=len(write_data))
         # ai.wait()
-        # for channel, array in enumerate(data):
-        #     read_data[channel].extend(array.tolist())
+        # read_data = data.copy()
 
 
 
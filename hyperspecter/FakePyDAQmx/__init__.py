@@ -1,6 +1,9 @@
 DAQmx_Val_Volts = 1
 DAQmx_Val_Rising = 1
 DAQmx_Val_ContSamps = 1
+DAQmx_Val_FiniteSamps = 10178
+DAQmx_Val_Falling = 10171
+DAQmx_Val_GroupByChannel = 0
 
 class Task:
     def __init__(self):
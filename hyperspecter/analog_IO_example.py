@@ -62,7 +62,7 @@ ao.WriteAnalogF64(
     autoStart=False,
     timeout=10,
     dataLayout=pdmx.DAQmx_Val_GroupByChannel,
-    writeArray=np.array([x/samples for x in range(samples)], dtype=np.float64),
+    writeArray=np.arange(samples, dtype=np.float64) * (1.0/samples),
     sampsPerChanWritten=None,
     reserved=None
 )
@@ -2,8 +2,51 @@ import numpy as np
 import pyqtgraph as pg
 from PyQt5 import QtWidgets, QtCore, QtGui
 
+try:
+    from numba import njit, prange
+    numba_loaded = True
+except:
+    numba_loaded = False
+    print('Numba failed to load. Scaling and auto-levelling images with NumPy.')
 
-pg.setConfigOptions(imageAxisOrder='row-major')
+
+pg.setConfigOptions(imageAxisOrder='row-major', useOpenGL=True, useNumba=numba_loaded) # render on the GPU and JIT the LUT/level mapping
+
+
+if numba_loaded:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def image_min_max(image):
+        ''' Returns the minimum and maximum of a 2D image in a single pass, reducing rows in parallel. '''
+        rows, columns = image.shape
+        row_minimums = np.empty(rows)
+        row_maximums = np.empty(rows)
+        for row in prange(rows):
+            minimum = image[row, 0]
+            maximum = image[row, 0]
+            for column in range(1, columns):
+                value = image[row, column]
+                if value < minimum: minimum = value
+                if value > maximum: maximum = value
+            row_minimums[row] = minimum
+            row_maximums[row] = maximum
+        return row_minimums.min(), row_maximums.max()
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def scale_to_uint8(image_data, minimums, maximums, display):
+        ''' Maps each channel of image_data [channel, y, x] from its [minimum, maximum] to [0, 255] into display in a single fused pass. '''
+        channels, rows, columns = image_data.shape
+        for row in prange(channels*rows):
+            channel = row // rows
+            y = row % rows
+            minimum = np.float32(minimums[channel])
+            span = np.float32(maximums[channel]) - minimum
+            if span == 0: span = np.float32(1.0) # flat levels, e.g. auto-levelled dark channels, would divide by zero
+            scale = np.float32(255.0)/span
+            for x in range(columns):
+                value = (np.float32(image_data[channel, y, x]) - minimum)*scale
+                if value < 0: value = 0
+                elif value > 255: value = 255
+                display[channel, y, x] = np.uint8(value)
 
 
 class ImageItem(pg.ImageItem):
@@ -22,13 +65,12 @@ class ImageItem(pg.ImageItem):
 class DisplayPanel(pg.GraphicsLayoutWidget):
     
     class Signal(QtCore.QObject):
-        resize = QtCore.pyqtSignal()
         update = QtCore.pyqtSignal()
         close  = QtCore.pyqtSignal()
 
-    signal = Signal()
-        
+
     __title  = "Hyperspecter - Display Panel"
+    __refresh_interval = 16 # milliseconds to wait before repainting, coalescing any frames set in the meantime (~60 Hz)
 
     def __init__(self, number_of_channels, channel_labels=['CARS', 'SHG', 'EPI-CARS', 'Back Scatter'], parent=None):
         ''' DisplayPanel displays a panel of microscope images where each column represents a different input channel.
@@ -42,15 +84,25 @@ class DisplayPanel(pg.GraphicsLayoutWidget):
     '''
         super().__init__()
         if channel_labels: assert len(channel_labels) == number_of_channels
+        self.signal = self.Signal()
         self.number_of_channels = number_of_channels
         self.channel_labels = channel_labels
         self.parent = parent
         self.images = []
         self.plots = []
-        self.image_levels = []
+        self.image_levels = np.empty((number_of_channels, 2), dtype=np.float64) # [channel, (minimum, maximum)]
         self.default_image_minimum = 0.0
         self.default_image_maximum = 1.0
         self.image_data = None
+        self.levels_changed = False # image levels changed since the current image was drawn
+        self.column_width = None # last column width set by rescale
+        self.scaling_buffer = None # float32 scratch and uint8 display images [channel, y, x] reused between frames
+        self.display_buffer = None
+        self.intensity_buffer = None # float32 [channel, intensity] buffer reused by the intensity plots, grown as needed
+        self.wavenumbers = None      # last wavenumbers set and their float32 conversion
+        self.wavenumber_axis = None
+        self.pending_image = None     # latest (image_data, image_minimums, image_maximums) waiting to be drawn
+        self.pending_intensity = None # latest (intensity_data, wavenumbers) waiting to be drawn
 
         self.setupUI()
         self.setupSignals()
@@ -70,72 +122,180 @@ class DisplayPanel(pg.GraphicsLayoutWidget):
             label = f'CH{channel}'
             if self.channel_labels:
                 label += f' : {self.channel_labels[channel]}'   
-            self.addLabel(label, row=0, col=channel)
+            label_item = self.addLabel(label, row=0, col=channel)
+            label_item.item.setCacheMode(QtWidgets.QGraphicsItem.DeviceCoordinateCache) # render the static text to a pixmap once, not every repaint
 
             # Add empty images
             vb = self.addViewBox(row=1, col=channel)
             vb.setAspectLocked()
             vb.setMouseEnabled(x=False, y=False)
             image = ImageItem(channel)
+            image.setOpts(autoDownsample=True) # only convert as many uint8 pixels as the view can show
             vb.addItem(image)
             self.images.append(image)
-            self.image_levels.append((self.default_image_minimum,self.default_image_maximum))
+            self.image_levels[channel] = (self.default_image_minimum, self.default_image_maximum)
             
             # Add empty plots
             plot = self.addPlot(row=2, col=channel)
             plot.setMouseEnabled(x=False, y=False)
-            self.plots.append(plot.plot()) # Initializes plot so it can be updated later
+            curve = plot.plot() # Initializes plot so it can be updated later
+            curve.setDownsampling(auto=True, method='peak') # only draw the visible peaks of long intensity traces
+            curve.setClipToView(True)
+            curve.setSkipFiniteCheck(True)
+            self.plots.append(curve)
 
         self.rescale()
 
+        # Repaint timer decouples the acquisition frame rate from the display refresh rate. 
+        # It only runs while there is something to draw so an idle display doesn't wake up.
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.setInterval(self.__refresh_interval)
+        self.refresh_timer.timeout.connect(self.refresh)
+
     def setupSignals(self):
         ''' Connects signals to slots. '''
-        self.signal.resize.connect(self.rescale)
+        self.signal.update.connect(self.scheduleRefresh) # queued onto the GUI thread when emitted from acquisition threads
 
     def resizeEvent(self, event):
-        self.signal.resize.emit()
+        self.rescale()
         return super().resizeEvent(event)
 
     def rescale(self):
-        width = self.frameGeometry().width()/self.number_of_channels - self.layout.horizontalSpacing()
+        width = int(self.frameGeometry().width()/self.number_of_channels - self.layout.horizontalSpacing())
         # print(width)
+        if width == self.column_width:
+            return
+        self.column_width = width
         for channel in range(self.number_of_channels):
             self.layout.setColumnFixedWidth(channel, width)
 
+    def scheduleRefresh(self):
+        ''' Starts the refresh timer unless a refresh is already scheduled. '''
+        if not self.refresh_timer.isActive():
+            self.refresh_timer.start()
+
+    def refresh(self):
+        ''' Draws the latest images and intensity plots set since the last refresh. Only the most recent of each is drawn. '''
+        if self.pending_image is not None:
+            pending_image, self.pending_image = self.pending_image, None
+            self.drawImage(*pending_image)
+        if self.pending_intensity is not None:
+            pending_intensity, self.pending_intensity = self.pending_intensity, None
+            self.drawIntensityPlot(*pending_intensity)
+
     def setImage(self, image_data, image_minimums=None, image_maximums=None):
-        ''' Sets the image.
+        ''' Sets the image. The image is drawn on the next refresh.
 
             INPUT :
                 image_data = 3D array containing the image data for each channel [channel,y,x]
+                    The channel axis must be first so that each channel is a contiguous row-major [y,x] slice.
+                    Non-contiguous data is copied once here rather than per channel further down.
+                    float32 and integer (e.g. uint16) data are displayed as they are. float64 data is converted to float32 
+                    here, halving the memory the display reads per frame.
                 image_minimums = 2D array containing minimum image intensities to be displayed for image levelling [channel, minimums]
                 image_maximums = 2D array containing maximum image intensities to be displayed for image levelling [channel, maximums]
                 
         '''
         assert len(image_data) == self.number_of_channels, f'image_data must contain {self.number_of_channels} channels. Create a new display to update number of channels.'
+        image_data = np.asarray(image_data)
+        image_data = np.ascontiguousarray(image_data, dtype=np.float32 if image_data.dtype == np.float64 else None)
+        self.pending_image = (image_data, image_minimums, image_maximums)
+        self.signal.update.emit()
+
+    def drawImage(self, image_data, image_minimums=None, image_maximums=None):
+        ''' Draws the image immediately. See setImage. 
+            Each channel is scaled to uint8 with its levels here, so pyqtgraph can turn it straight into a grayscale QImage.
+        '''
+        # Skip redrawing when the same frame is set again with the current levels
+        if image_data is self.image_data and image_minimums is None and image_maximums is None and not self.levels_changed:
+            return
+        self.image_data = image_data
+        self.levels_changed = False
 
-        if not image_minimums:
-            image_minimums = [levels[0] for levels in self.image_levels]
-        if not image_maximums:
-            image_maximums = [levels[1] for levels in self.image_levels]
+        if image_minimums is None:
+            image_minimums = self.image_levels[:, 0]
+        if image_maximums is None:
+            image_maximums = self.image_levels[:, 1]
 
-        for channel in range(self.number_of_channels):
-            self.images[channel].setImage(image_data[channel], levels=[image_minimums[channel],image_maximums[channel]])
-            # self.images[channel].setImage(image_data[channel], autoLevels=True)
+        display = self.scaleToUint8(image_data, image_minimums, image_maximums)
+
+        # Update every channel with viewport updates held back so the panel repaints once rather than once per channel
+        viewport = self.viewport()
+        viewport.setUpdatesEnabled(False)
+        try:
+            for channel, image in enumerate(self.images):
+                if image.image is not None and image.image.base is display:
+                    image.updateImage() # the display buffer was rewritten in place with the same shape, so only re-render it
+                else:
+                    image.setImage(display[channel], autoLevels=False, autoDownsample=True, levels=(0, 255))
+                # self.images[channel].setImage(image_data[channel], autoLevels=True)
+        finally:
+            viewport.setUpdatesEnabled(True)
+            viewport.update()
+
+    def scaleToUint8(self, image_data, image_minimums, image_maximums):
+        ''' Maps every channel of image_data from its [minimum, maximum] to [0, 255] in one vectorized pass.
+            Returns the reused uint8 display buffer [channel, y, x].
+        '''
+        if self.display_buffer is None or self.display_buffer.shape != image_data.shape:
+            self.scaling_buffer = None
+            self.display_buffer = np.empty(image_data.shape, dtype=np.uint8)
+
+        if numba_loaded:
+            scale_to_uint8(image_data, np.asarray(image_minimums, dtype=np.float32), np.asarray(image_maximums, dtype=np.float32), self.display_buffer)
+            return self.display_buffer
+
+        # NumPy fallback in steps through a float32 scratch buffer
+        if self.scaling_buffer is None:
+            self.scaling_buffer = np.empty(image_data.shape, dtype=np.float32)
+        minimums = np.asarray(image_minimums, dtype=np.float32)
+        spans = np.asarray(image_maximums, dtype=np.float32) - minimums
+        spans[spans == 0] = 1.0 # flat levels, e.g. auto-levelled dark channels, would divide by zero
+        scales = 255.0 / spans
+        np.subtract(image_data, minimums[:, None, None], out=self.scaling_buffer, casting='unsafe')
+        np.multiply(self.scaling_buffer, scales[:, None, None], out=self.scaling_buffer)
+        np.clip(self.scaling_buffer, 0, 255, out=self.scaling_buffer)
+        self.display_buffer[...] = self.scaling_buffer
+        return self.display_buffer
+
+    def redraw(self):
+        ''' Schedules the current image to be redrawn with the current levels. Level changes made before the next refresh share one repaint. '''
+        self.levels_changed = True
+        if self.image_data is not None and self.pending_image is None:
+            self.pending_image = (self.image_data, None, None)
+            self.scheduleRefresh()
 
     def setIntensityPlot(self, intensity_data, wavenumbers=None):
-        ''' Sets the average intensity plot. 
+        ''' Sets the average intensity plot. The plot is drawn on the next refresh.
 
             INPUT :
                 intensity_data = 2D array containing the average image intensity for any previous images having type [channel,intensity]
                 wavenumbers = 2D array containing the wavenumbers to associate with each value in intensity_data having type [channel,wavenumber]
         '''
         assert len(intensity_data) == self.number_of_channels, f'intensity_data must contain {self.number_of_channels} channels. Create a new display to update number of channels.'
+        self.pending_intensity = (intensity_data, wavenumbers)
+        self.signal.update.emit()
+
+    def drawIntensityPlot(self, intensity_data, wavenumbers=None):
+        ''' Draws the average intensity plot immediately. See setIntensityPlot. '''
+        # Cast once into a reused float32 buffer, which is what pyqtgraph draws with anyway.
+        intensity_data = np.asarray(intensity_data) # already a [channel, intensity] array from the acquisition
+        length = intensity_data.shape[1]
+        if self.intensity_buffer is None or self.intensity_buffer.shape[1] < length:
+            self.intensity_buffer = np.empty((self.number_of_channels, max(2*length, 256)), dtype=np.float32)
+        intensities = self.intensity_buffer[:, :length]
+        intensities[...] = intensity_data
+
+        if wavenumbers is not None and wavenumbers is not self.wavenumbers:
+            self.wavenumbers = wavenumbers
+            self.wavenumber_axis = np.asarray(wavenumbers, dtype=np.float32)
 
         for channel in range(self.number_of_channels):
-            if wavenumbers:
-                self.plots[channel].setData(y=intensity_data[channel], x=wavenumbers)
+            if wavenumbers is not None:
+                self.plots[channel].setData(y=intensities[channel], x=self.wavenumber_axis[:length])
             else:
-                self.plots[channel].setData(intensity_data[channel])
+                self.plots[channel].setData(intensities[channel])
 
     def setDefaultImageLevels(self, minimum=0, maximum=1):
         self.default_image_minimum = minimum
@@ -148,21 +308,28 @@ class DisplayPanel(pg.GraphicsLayoutWidget):
             levels: list containing levels=(min, max) for each image. Dimension: [channel, levels]
         
         '''
-        self.image_levels = image_levels
-        for i,image in enumerate(self.images):
-            image.setLevels(image_levels[i])
+        self.image_levels[:] = image_levels
+        self.redraw() # levels are applied when scaling to uint8
 
     def autoLevel(self):
-        for channel, image in enumerate(self.images):
-            try:
-                img_levels = image.quickMinMax(targetSize=10000) # get image levels quickly
-                levels = (0.0, img_levels[1] * 1.1) # set max levels to image maximums giving 10% head room, keep min at 0 for absolute baseline
-                self.image_levels[channel] = levels
-                image.setLevels(levels)
-                print(f'Image {channel} autolevels: {levels}')
-            except:
-                pass
-            
+        image_data = self.image_data # displayed images are already scaled, so level from the raw data
+        if image_data is None or image_data.size == 0:
+            return
+        if numba_loaded and image_data[0].size > 256*256:
+            maximums = np.array([image_min_max(channel_data)[1] for channel_data in image_data]) # exact maximums in one parallel pass for large images
+        else:
+            # get image levels quickly from a strided subsample of ~10000 pixels per channel, reducing all channels at once
+            height, width = image_data.shape[1:]
+            stride = max(1, int(np.sqrt(height*width/10000)))
+            maximums = np.nanmax(image_data[:, ::stride, ::stride], axis=(1, 2))
+        # set max levels to image maximums giving 10% head room, keep min at 0 for absolute baseline
+        # channels without a finite maximum (e.g. all NaN early frames) keep their current levels
+        valid = np.isfinite(maximums)
+        self.image_levels[valid, 0] = 0.0
+        self.image_levels[valid, 1] = maximums[valid] * 1.1
+        for channel, levels in enumerate(self.image_levels):
+            print(f'Image {channel} autolevels: {tuple(levels)}')
+        self.redraw()
 
     def closeEvent(self, event):
         self.signal.close.emit()
@@ -176,6 +343,6 @@ if __name__ == '__main__':
     labels = ['CARS', 'E-CARS', 'TPEF', 'SHG']
     resolution = 250
     display_panel = DisplayPanel(channels, labels)
-    display_panel.setImage(np.random.randn(channels,resolution,resolution))
-    display_panel.setIntensityPlot(np.random.randn(channels,100))
+    display_panel.setImage(np.random.randn(channels,resolution,resolution).astype(np.float32))
+    display_panel.setIntensityPlot(np.random.randn(channels,100).astype(np.float32))
     app.exec_()
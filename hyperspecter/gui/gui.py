@@ -12,12 +12,14 @@ class HyperspecterGUI(QtWidgets.QMainWindow):
         update = QtCore.pyqtSignal()
         close = QtCore.pyqtSignal()
         generate_delay_stage_positions = QtCore.pyqtSignal()
+        images = QtCore.pyqtSignal(object)      # image data [channel, y, x]
+        intensities = QtCore.pyqtSignal(object) # intensity data [channel, intensity]
 
     def __init__(self, channels=4):
         super().__init__()
         self.number_of_channels = channels
         self.signal = self.Signal()
-        self.display_panel = DisplayPanel(self.number_of_channels, parent=self)
+        self.display_panel = None # created when acquisition starts, keeping window startup quick
         self.acquiring = False
         self.setupUI()
         self.setupSignals()
@@ -30,67 +32,91 @@ class HyperspecterGUI(QtWidgets.QMainWindow):
         screen = QtGui.QGuiApplication.primaryScreen().geometry()
         size = self.geometry()
         self.move(0, screen.height() - size.height() - 100)
+        self.setupSettingsGetters()
         self.activateWindow()
         self.show()
 
+    def setupSettingsGetters(self):
+        ''' Builds the (key, getter) pairs read by getSettings once, so polling the settings only calls the widget getters. '''
+        ui = self.ui
+        self.settings_getters = [
+            ('scan mode', ui.scanModeWidget.currentText),
+            ('filename', ui.filenameText.text),
+            ('directory', ui.directoryText.text),
+            ('save', ui.saveCheckBox.isChecked),
+            ('simulate', ui.simulateCheckBox.isChecked),
+            ('zoom', lambda: int(ui.zoomWidget.value())),
+            ('line dwell time', lambda: int(ui.lineDwellTimeWidget.value())),
+            ('image resolution', lambda: int(ui.resolutionWidget.value())),
+            ('flyback', lambda: int(ui.flybackWidget.value())),
+            ('fill fraction', ui.fillFractionWidget.value),
+            ('galvo y-axis offset', ui.galvoOffsetWidget.value),
+            ('scan delay', ui.scanDelayWidget.value),
+            ('scan pattern', ui.scanPatternWidget.currentText),
+            ('scan start', ui.scanStartWidget.value),
+            ('scan end', ui.scanEndWidget.value),
+            ('step size', ui.stepSizeWidget.value),
+            ('pump power', ui.pumpPowerWidget.value),
+            ('stokes power', ui.stokesPowerWidget.value),
+            ('image levels', lambda: self.display_panel.image_levels.tolist() if self.display_panel else None), # stringified only when saved
+            ('delay presets', lambda: (ui.delayStagePresetWidget0.value(), ui.delayStagePresetWidget1.value(), ui.delayStagePresetWidget2.value())),
+            ('calibration', lambda: (ui.calibrationWidget0.value(), ui.calibrationWidget1.value(), ui.calibrationWidget2.value())),
+            ('polarization scan start', ui.polarizationScanStartWidget.value),
+            ('polarization scan end', ui.polarizationScanEndWidget.value),
+            ('polarization step size', ui.polarizationScanStepSizeWidget.value),
+        ]
+
     def setupSignals(self):
         self.ui.actionQuit.triggered.connect(self.close)
         self.ui.directoryBrowseButton.clicked.connect(lambda: self.ui.directoryText.setText(QtWidgets.QFileDialog.getExistingDirectory()))
-        self.display_panel.signal.close.connect(self.displayClosed)
-        self.ui.autoLevelButton.clicked.connect(self.display_panel.autoLevel)
+        self.ui.autoLevelButton.clicked.connect(self.autoLevel)
+
+        # Acquisition threads emit images and intensities, which are queued onto the GUI thread
+        self.signal.images.connect(self.updateImages, QtCore.Qt.QueuedConnection)
+        self.signal.intensities.connect(self.updateIntensityPlots, QtCore.Qt.QueuedConnection)
 
         # Sets text above sliders to display value of slider
-        self.ui.PMTSlider0.valueChanged.connect(lambda: self.ui.PMTLevel0.setText(str(self.ui.PMTSlider0.value())))
-        self.ui.PMTSlider1.valueChanged.connect(lambda: self.ui.PMTLevel1.setText(str(self.ui.PMTSlider1.value())))
-        self.ui.PMTSlider2.valueChanged.connect(lambda: self.ui.PMTLevel2.setText(str(self.ui.PMTSlider2.value())))
-        self.ui.PMTSlider3.valueChanged.connect(lambda: self.ui.PMTLevel3.setText(str(self.ui.PMTSlider3.value())))
+        for channel in range(self.number_of_channels):
+            slider = getattr(self.ui, f'PMTSlider{channel}')
+            slider.valueChanged.connect(getattr(self.ui, f'PMTLevel{channel}').setNum) # native Qt slot, no Python per tick
 
         # Update timer to periodically emit update signal
         self.timer = QtCore.QTimer(self)
-        self.timer.setSingleShot(False)
+        self.timer.setSingleShot(True)
         self.timer.setInterval(500) # in milliseconds
-        self.timer.timeout.connect(lambda: self.signal.update.emit())
+        self.timer.timeout.connect(self.tick)
+        self.timer.start()
+
+    def tick(self):
+        ''' Emits the update signal and schedules the next tick once the update has been handled, so slow updates never stack up.
+            Updates are skipped while the window is minimized since nothing they refresh is visible.
+        '''
+        if not self.isMinimized():
+            self.signal.update.emit()
         self.timer.start()
 
     def displayClosed(self):
         self.display_panel = None
         
     def createDisplayPanel(self):
+        ''' Creates the display panel. Must be called from the GUI thread, before any images are set. '''
         self.display_panel = DisplayPanel(self.number_of_channels, parent=self)
+        self.display_panel.signal.close.connect(self.displayClosed)
+
+    def autoLevel(self):
+        if self.display_panel:
+            self.display_panel.autoLevel()
 
     def updateImages(self, image_data, levels=None):
-        self.display_panel.setImage(image_data, levels)
+        if self.display_panel:
+            self.display_panel.setImage(image_data, levels)
 
     def updateIntensityPlots(self, intensity_data, wavenumbers=None):
-        self.display_panel.setIntensityPlot(intensity_data, wavenumbers)
+        if self.display_panel:
+            self.display_panel.setIntensityPlot(intensity_data, wavenumbers)
     
     def getSettings(self):
-        settings = {}
-        settings['scan mode'] = self.ui.scanModeWidget.currentText()
-        settings['filename'] = self.ui.filenameText.text()
-        settings['directory'] = self.ui.directoryText.text()
-        settings['save'] = self.ui.saveCheckBox.isChecked()
-        settings['simulate'] = self.ui.simulateCheckBox.isChecked()
-        settings['zoom'] = int(self.ui.zoomWidget.value())
-        settings['line dwell time'] = int(self.ui.lineDwellTimeWidget.value())
-        settings['image resolution'] = int(self.ui.resolutionWidget.value())
-        settings['flyback'] = int(self.ui.flybackWidget.value())
-        settings['fill fraction'] = self.ui.fillFractionWidget.value()
-        settings['galvo y-axis offset'] = self.ui.galvoOffsetWidget.value()
-        settings['scan delay'] = self.ui.scanDelayWidget.value()
-        settings['scan pattern'] = self.ui.scanPatternWidget.currentText()
-        settings['scan start'] = self.ui.scanStartWidget.value()
-        settings['scan end'] = self.ui.scanEndWidget.value()
-        settings['step size'] = self.ui.stepSizeWidget.value()
-        settings['pump power'] = self.ui.pumpPowerWidget.value()
-        settings['stokes power'] = self.ui.stokesPowerWidget.value()
-        settings['image levels'] = f'{self.display_panel.image_levels}'
-        settings['delay presets'] = (self.ui.delayStagePresetWidget0.value(),self.ui.delayStagePresetWidget1.value(),self.ui.delayStagePresetWidget2.value())
-        settings['calibration'] = (self.ui.calibrationWidget0.value(),self.ui.calibrationWidget1.value(),self.ui.calibrationWidget2.value())
-        settings['polarization scan start'] = self.ui.polarizationScanStartWidget.value()
-        settings['polarization scan end'] = self.ui.polarizationScanEndWidget.value()
-        settings['polarization step size'] = self.ui.polarizationScanStepSizeWidget.value()
-        return settings
+        return {key: getter() for key, getter in self.settings_getters}
 
     def setSettings(self, settings):
         self.ui.filenameText.setText(settings['filename'])
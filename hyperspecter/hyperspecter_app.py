@@ -5,6 +5,7 @@ from ctypes import c_short
 import traceback
 import configparser
 from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
 import numpy as np
@@ -27,6 +28,27 @@ except:
     print('MCC failed to load')
 
 
+class FrameProcessor(QtCore.QThread):
+    acquisitionFinished = QtCore.pyqtSignal() # emitted when the producer's sentinel arrives
+
+    def __init__(self, process_frames):
+        ''' Qt thread that runs the frame processing loop, i.e. the consumer of the producer-consumer pattern. 
+            It is created once and restarted for each acquisition with the queues set by setQueues.
+            Processed frames reach the GUI through queued signals.
+        '''
+        super().__init__()
+        self.process_frames = process_frames
+        self.image_q = None
+        self.save_q = None
+
+    def setQueues(self, image_q, save_q=None):
+        self.image_q = image_q
+        self.save_q = save_q
+
+    def run(self):
+        self.process_frames(self.image_q, self.save_q)
+
+
 class Hyperspecter:
     def __init__(self):
         ''' Hyperspecter application. 
@@ -39,6 +61,10 @@ class Hyperspecter:
         self.gui = HyperspecterGUI()
         self.settings = self.gui.getSettings()
         self.microscope = MicroscopeController()
+        self.frame_processor = FrameProcessor(self.process_frames)
+        # stop_acquire updates widgets so it has to run on the GUI thread when the processor sees the end of an acquisition
+        self.frame_processor.acquisitionFinished.connect(self.stop_acquire, QtCore.Qt.QueuedConnection)
+        utils.generate_sawtooth_scan(resolution=(2, 2)) # compiles the scan waveform kernel now instead of on the first acquisition
         
         delay_name = 'DDS220'
         delay_serial_number = stages[delay_name]['SN']
@@ -53,15 +79,21 @@ class Hyperspecter:
         '''
         Coefficients of the polynomials used for calibration.
         Use:
-            np.polyval(self.delay_to_wavenumber, delays) 
-            np.polyval(self.wavenumber_to_delay, wavenumbers)
+            utils.horner(self.delay_to_wavenumber, delays) 
+            utils.horner(self.wavenumber_to_delay, wavenumbers)
         to obtain wavenumbers/delays from delays/wavenumbers. Delays in [mm], wavenumbers in [cm-1]
         '''
         self.delay_to_wavenumber = [870.38, -63210]
         self.wavenumber_to_delay = [0.0011, 72.37]
+        self.delay_positions_cache = {} # scan delay positions by (start, end, step)
         
-        self.image_data = []
-        self.average_intensities = [[] for _ in range(self.microscope.number_of_channels)]
+        self.image_data = None # stored frames [frame, channel, y, x], grown as frames are added
+        self.frame_count = 0   # number of frames stored in image_data
+        self.expected_frames = 16 # initial frame capacity of image_data
+        self.simulated_scan_frames = 10 # number of frames acquired by a simulated scan
+        self.intensity_history = 1024 # number of average intensities kept per channel for the intensity plots
+        self.average_intensities = np.zeros((self.microscope.number_of_channels, self.intensity_history), dtype=np.float32) # ring buffer [channel, frame]
+        self.intensity_count = 0 # number of average intensities added since the data was cleared
         self.PMT_levels = [0,0,0,0]
         self.PMT_powered = False
         self.microscope_open = False
@@ -124,20 +156,31 @@ class Hyperspecter:
         )
         self.gui.ui.estimatedPolarizationScanTimeLabel.setText(f'Estimated Scan Time: {scan_time} seconds')
 
-        # Update current delay stage position
+        # Convert the current delay stage position, preset positions and scan range to wavenumbers in one evaluation
+        ui = self.gui.ui
         delay_position = self.delay_stage.get_position()
-        wavenumber = np.polyval(self.delay_to_wavenumber, delay_position)
-        self.gui.ui.delayStagePosition.setText(f'{delay_position:.3f} mm ({wavenumber:.0f} cm-1)')
+        delays = np.array([
+            delay_position,
+            ui.delayStagePresetWidget0.value(),
+            ui.delayStagePresetWidget1.value(),
+            ui.delayStagePresetWidget2.value(),
+            ui.scanStartWidget.value(),
+            ui.scanEndWidget.value(),
+        ])
+        wavenumber, preset0, preset1, preset2, scan_start, scan_end = utils.horner(self.delay_to_wavenumber, delays)
+
+        # Update current delay stage position
+        ui.delayStagePosition.setText(f'{delay_position:.3f} mm ({wavenumber:.0f} cm-1)')
 
         # Update preset values wavenumber calculations
-        self.gui.ui.delayStagePreset0.setText(f'{np.polyval(self.delay_to_wavenumber, self.gui.ui.delayStagePresetWidget0.value()):.0f} cm-1')
-        self.gui.ui.delayStagePreset1.setText(f'{np.polyval(self.delay_to_wavenumber, self.gui.ui.delayStagePresetWidget1.value()):.0f} cm-1')
-        self.gui.ui.delayStagePreset2.setText(f'{np.polyval(self.delay_to_wavenumber, self.gui.ui.delayStagePresetWidget2.value()):.0f} cm-1')
+        ui.delayStagePreset0.setText(f'{preset0:.0f} cm-1')
+        ui.delayStagePreset1.setText(f'{preset1:.0f} cm-1')
+        ui.delayStagePreset2.setText(f'{preset2:.0f} cm-1')
 
         # Update scan values wavenumber calculations
-        self.gui.ui.scanStartWavenumber.setText(f'{np.polyval(self.delay_to_wavenumber, self.gui.ui.scanStartWidget.value()):.0f} cm-1')
-        self.gui.ui.scanEndWavenumber.setText(f'{np.polyval(self.delay_to_wavenumber, self.gui.ui.scanEndWidget.value()):.0f} cm-1')
-        self.gui.ui.scanStepWavenumber.setText(f'{self.delay_to_wavenumber[0]*self.gui.ui.stepSizeWidget.value():.0f} cm-1')
+        ui.scanStartWavenumber.setText(f'{scan_start:.0f} cm-1')
+        ui.scanEndWavenumber.setText(f'{scan_end:.0f} cm-1')
+        ui.scanStepWavenumber.setText(f'{self.delay_to_wavenumber[0]*ui.stepSizeWidget.value():.0f} cm-1')
 
 
     def gui_closed(self):
@@ -145,6 +188,7 @@ class Hyperspecter:
         self.acquiring = False
         self.set_PMT_off()
         self.microscope.stop()
+        self.frame_processor.wait(1000) # let the processor finish the last frame before the application exits
         if mcc_loaded:
             self.close_stokes_shutter()
             self.close_pump_shutter()
@@ -218,8 +262,7 @@ class Hyperspecter:
     def set_PMT_on(self):
         # turn on PMTs
         if mcc_loaded:
-            for channel, PMT_level in enumerate(self.PMT_levels):
-                self.MCC.set_analog_out(PMT_level, channel)
+            self.MCC.set_analog_outs(self.PMT_levels)
             self.gui.ui.PMTStatus.setText('On')
             self.PMT_powered = True
 
@@ -227,8 +270,7 @@ class Hyperspecter:
     def set_PMT_off(self):
         # turn off PMTs
         if mcc_loaded:
-            for channel, PMT_level in enumerate(self.PMT_levels):
-                self.MCC.set_analog_out(0.0, channel)
+            self.MCC.set_analog_outs([0.0]*len(self.PMT_levels))
             self.gui.ui.PMTStatus.setText('Off')
             self.PMT_powered = False
 
@@ -241,6 +283,11 @@ class Hyperspecter:
 
 
     def acquire(self):
+        # A stopped acquisition's processor only has its last frames and sentinel left to take, but never block the GUI thread on it for long
+        if not self.frame_processor.wait(1000):
+            print('Frame processor is still busy with the previous acquisition. Try again.')
+            return
+
         self.acquiring = True
         self.gui.ui.acquireButton.setText('Stop')
         if self.gui.display_panel is None:
@@ -261,11 +308,19 @@ class Hyperspecter:
             # Create csv for average intensities
             np.savetxt(f'{self.save_directory}/intensities.csv', [], delimiter=',', header='CH0,CH1,CH2,CH3')
         
+        # Saving stage runs on its own thread so TIFF conversion and disk writes don't hold up processing and display
+        save_q = None
+        if self.settings['save']:
+            # Keep a TIFF open per channel for the whole acquisition so each frame is appended without re-reading the file
+            tiff_writers = [tf.TiffWriter(f'{self.save_directory}/CH{channel}.tiff', bigtiff=True) for channel in range(self.microscope.number_of_channels)]
+            save_q = Queue(maxsize=4) # bounded so a slow disk holds back processing instead of filling memory
+            save_thread = Thread(target=self.save_frames, args=(save_q, tiff_writers, self.save_directory), daemon=True)
+            save_thread.start()
+
         # Producer-consumer pattern for image processing
-        image_q = Queue() # images are pushed as they are produced and pulled when they are ready to be processed
-        consumer_thread = Thread(target=self.process_frames, args=(image_q,))
-        consumer_thread.deamon = True
-        consumer_thread.start()
+        image_q = Queue(maxsize=8) # images are pushed as they are produced and pulled when they are ready to be processed. Producers block when it is full.
+        self.frame_processor.setQueues(image_q, save_q)
+        self.frame_processor.start()
         
         if not self.settings['simulate']:
             self.set_PMT_on()
@@ -281,7 +336,7 @@ class Hyperspecter:
             
         elif scan_mode == 'Scan':
             print('scan')
-            self.clear_data()
+            self.clear_data(expected_frames=self.simulated_scan_frames if self.settings['simulate'] else len(self.get_delay_positions()))
             producer_thread = Thread(target=self.acquire_scan, args=(image_q,))
             producer_thread.deamon = True
             producer_thread.start()
@@ -302,96 +357,183 @@ class Hyperspecter:
         self.gui.ui.acquireButton.setText('Acquire')
 
 
-    def process_frames(self, image_q):
-        while self.acquiring:
-            frame = image_q.get()
+    def process_frames(self, image_q, save_q=None):
+        frame = 0 # anything but the sentinel
+        save_levels = None # levels of the last frame handed to the saving stage, kept in case the display is closed
+        try:
+            while self.acquiring:
+                frame = image_q.get()
 
-            if frame is None:
-                self.stop_acquire()
-                break
+                if frame is None:
+                    self.frame_processor.acquisitionFinished.emit()
+                    break
 
-            # Storing image data for further use
-            self.image_data.append(frame)
-            for channel, array in enumerate(frame):
-                self.average_intensities[channel].append(np.mean(array))
+                # Storing image data for further use
+                self.store_frame(frame)
+                # every channel in one float32 reduction, written straight into the ring buffer
+                average_intensities = self.average_intensities[:, self.intensity_count % self.intensity_history]
+                frame.mean(axis=(1, 2), dtype=np.float32, out=average_intensities)
+                self.intensity_count += 1
+
+                # Hand the frame to the saving stage with the levels it was displayed at
+                if save_q is not None:
+                    display_panel = self.gui.display_panel # read once, closing the display sets it to None
+                    if display_panel is not None:
+                        save_levels = display_panel.image_levels.copy()
+                    elif save_levels is None:
+                        save_levels = np.stack((frame.min(axis=(1, 2)), frame.max(axis=(1, 2))), axis=1)
+                    save_q.put((frame, save_levels, average_intensities.copy()))
+
+                # Display images on the GUI thread
+                self.gui.signal.images.emit(frame)
+                self.gui.signal.intensities.emit(self.get_average_intensities())
+
+        finally:
+            # Even if processing failed, keep emptying the bounded image queue until the producer's sentinel so it is never
+            # left blocked on put, and always let the saving stage finish its files
+            while frame is not None:
+                frame = image_q.get()
+
+            if save_q is not None:
+                save_q.put(None) # sentinel value
+
+
+    def save_frames(self, save_q, tiff_writers, save_directory):
+        ''' Saves each (frame, image levels, average intensities) pulled from save_q to the per channel TiffWriters as 16 bit images 
+            and appends its average intensities to the csv in save_directory. Sentinel value of None type closes the files.
+        '''
+        item = 0 # anything but the sentinel
+        try:
+            # Keep the intensities csv open for the whole acquisition instead of reopening it for every frame
+            with open(f'{save_directory}/intensities.csv', 'a') as csv_file:
+                while True:
+                    item = save_q.get()
+                    if item is None:
+                        break
+                    frame, image_levels, average_intensities = item
+
+                    # Save images, quantizing every channel with its own levels in one pass
+                    frame = utils.convert_to_16_bit(frame, image_levels[:, 0, None, None], image_levels[:, 1, None, None])
+                    frame = np.flip(frame, 1) # Fixes y axis flipping when saving
+                    for channel, array in enumerate(frame):
+                        tiff_writers[channel].write(array, contiguous=True)
 
-                # Save images
-                if self.settings['save']:
-                    levels = self.gui.display_panel.image_levels[channel]
-                    array = utils.convert_to_16_bit(array, levels[0], levels[1])
-                    array = np.flip(array, 0) # Fixes y axis flipping when saving
-                    tf.imwrite(f'{self.save_directory}/CH{channel}.tiff', array, append=True, bigtiff=True)
-            
-            if self.settings['save']:
-                average_intensities = np.array([np.mean(channel) for channel in frame])
-                with open(f'{self.save_directory}/intensities.csv', 'a') as file:
                     # append average intensities to csv
-                    np.savetxt(file, [average_intensities], delimiter=',')
+                    np.savetxt(csv_file, [average_intensities], delimiter=',')
 
-            # Display images
-            self.gui.updateImages(frame)
-            self.gui.updateIntensityPlots(self.average_intensities)
+        finally:
+            # Close the TIFFs from the thread that writes them, even if saving failed, so they are never left truncated
+            for writer in tiff_writers:
+                writer.close()
+
+            # Keep emptying the bounded save queue until its sentinel so processing is never left blocked on put
+            while item is not None:
+                item = save_q.get()
 
 
     def acquire_frame(self, image_q):
         ''' Acquires a single frame and adds it to the queue. '''
-        frame = self.microscope.get_frame()
-        image_q.put(frame)
-        image_q.put(None) # add sentinel value
+        try:
+            frame = self.microscope.get_frame()
+            image_q.put(frame)
+        finally:
+            image_q.put(None) # add sentinel value, even if acquiring failed, since the frame processor waits for it
 
 
     def acquire_scan(self, image_q):
         ''' Scan method that adds each frame in a scan to the image_q queue. '''
 
-        if self.settings['simulate']:
-            
-            for _ in range(10):
-                frame = self.microscope.get_frame()
-                image_q.put(frame)
-        else:
-
-            # Calculate scan points
-            start = self.settings['scan start']
-            end = self.settings['scan end']
-            step = self.settings['step size']
-            if end < start:
-                step = -1*step
+        try:
+            if self.settings['simulate']:
             
-            delay_positions = np.arange(start, end+step, step)
-
-            ### initiate scan
-            for position in delay_positions:
-                try:
-                    
-                    ### set delay stage position
-                    self.delay_stage.move_abs(position)
+                for _ in range(self.simulated_scan_frames):
                     frame = self.microscope.get_frame()
                     image_q.put(frame)
+            else:
 
-                    if not self.acquiring: break
+                # Calculate scan points
+                delay_positions = self.get_delay_positions()
 
-                except:
-                    break
+                ### initiate scan
+                with ThreadPoolExecutor(max_workers=1) as move_executor:
+                    for position in delay_positions:
+                        try:
+                        
+                            ### set delay stage position, configuring the next frame while the stage moves
+                            move = move_executor.submit(self.delay_stage.move_abs, position)
+                            self.microscope.prepare_frame()
+                            move.result() # only scan once the stage has arrived, re-raising a failed move so the scan stops
+                            frame = self.microscope.read_frame()
+                            image_q.put(frame)
+
+                            if not self.acquiring: break
 
-        image_q.put(None) # add sentinel value
-        print('scan finished')
+                        except:
+                            break
+
+        finally:
+            image_q.put(None) # add sentinel value, even if the scan failed, since the frame processor waits for it
+            print('scan finished')
 
 
     def monitor(self, image_q):
         ''' Scan method that continuously adds frames to the image_q queue. '''
-        while self.acquiring:
-            try:
-                frame = self.microscope.get_frame()
-                image_q.put(frame)
-            except KeyboardInterrupt:
-                break
+        try:
+            while self.acquiring:
+                try:
+                    frame = self.microscope.get_frame()
+                    image_q.put(frame)
+                except KeyboardInterrupt:
+                    break
         
-        image_q.put(None) # add sentinel value
+        finally:
+            image_q.put(None) # add sentinel value, even if acquiring failed, since the frame processor waits for it
 
 
-    def clear_data(self):
-        self.image_data = []
-        self.average_intensities = [[] for _ in range(self.microscope.number_of_channels)]
+    def get_delay_positions(self):
+        ''' Returns the delay stage positions [mm] of the scan set in the settings. 
+            Positions are cached by scan range so repeated scans reuse them. The returned array must not be modified.
+        '''
+        start = self.settings['scan start']
+        end = self.settings['scan end']
+        step = self.settings['step size']
+        if end < start:
+            step = -1*step
+        key = (start, end, step)
+        if key not in self.delay_positions_cache:
+            self.delay_positions_cache[key] = np.arange(start, end+step, step)
+        return self.delay_positions_cache[key]
+
+
+    def store_frame(self, frame):
+        ''' Stores frame after the frames already in image_data. 
+            image_data starts with room for expected_frames and doubles its capacity whenever it fills up.
+            Frames with a different shape to the stored ones (e.g. after changing the resolution) start a new image_data.
+        '''
+        if self.image_data is None or self.image_data.shape[1:] != frame.shape:
+            self.image_data = np.empty((self.expected_frames, *frame.shape), dtype=frame.dtype)
+            self.frame_count = 0
+        elif self.frame_count == len(self.image_data):
+            image_data = np.empty((2*len(self.image_data), *frame.shape), dtype=self.image_data.dtype)
+            image_data[:self.frame_count] = self.image_data
+            self.image_data = image_data
+        self.image_data[self.frame_count] = frame
+        self.frame_count += 1
+
+
+    def get_average_intensities(self):
+        ''' Returns the most recent average intensities [channel, frame] in the order they were acquired. 
+            Until the ring buffer wraps around this is a view of it, afterwards a rolled copy.
+        '''
+        if self.intensity_count <= self.intensity_history:
+            return self.average_intensities[:, :self.intensity_count]
+        return np.roll(self.average_intensities, -(self.intensity_count % self.intensity_history), axis=1)
+
+    def clear_data(self, expected_frames=16):
+        self.image_data = None
+        self.frame_count = 0
+        self.expected_frames = max(1, expected_frames)
+        self.intensity_count = 0
 
 def handle_exception(exc_type, exc_value, exc_traceback):
         ''' Prints error that crashed application. '''
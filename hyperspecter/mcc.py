@@ -1,7 +1,7 @@
-import math
+import ctypes
 
 from mcculw import ul
-from mcculw.enums import ULRange, DigitalPortType, DigitalIODirection
+from mcculw.enums import ULRange, DigitalPortType, DigitalIODirection, ScanOptions
 
 
 model_specs = {
@@ -46,12 +46,34 @@ class MCCDev:
         self.resolution = model_specs[model]['resolution']
         self.range = model_specs[model]['range']
         self.port_type = model_specs[model]['port type']
+        self.max_voltage = model_specs[model]['max voltage']
+        ul.d_config_port(self.board_num, self.port_type, DigitalIODirection.OUT) # configured once, the port only ever drives outputs
+        self.analog_out_buffer = ul.win_buf_alloc(self.number_of_channels) # one code per channel for set_analog_outs
+
+    def __del__(self):
+        analog_out_buffer = getattr(self, 'analog_out_buffer', None) # missing if __init__ failed before allocating it
+        if analog_out_buffer:
+            ul.win_buf_free(analog_out_buffer)
+            self.analog_out_buffer = None
 
     def set_analog_out(self, voltage, channel):
-        ''' Sets analog output channel voltage. Voltage must be in the ULRange specified for the given device model. '''
-        assert channel in range(self.number_of_channels), 'Invalid channel number.'
+        ''' Sets analog output channel voltage. Voltages outside the ULRange specified for the given device model are clamped to it. 
+            Invalid channel numbers are rejected by the driver with a ULError.
+        '''
+        voltage = 0.0 if voltage < 0 else (self.max_voltage if voltage > self.max_voltage else voltage)
         ul.v_out(self.board_num, channel, self.range, voltage)
 
+    def set_analog_outs(self, voltages):
+        ''' Sets the voltages of analog output channels 0 to len(voltages)-1 simultaneously in a single scan, 
+            rather than one USB transaction per channel. Voltages outside the ULRange specified for the given device model are clamped to it. 
+        '''
+        number_of_channels = len(voltages)
+        assert 0 < number_of_channels <= self.number_of_channels, 'Invalid number of channels.'
+        codes = ctypes.cast(self.analog_out_buffer, ctypes.POINTER(ctypes.c_ushort))
+        for channel, voltage in enumerate(voltages):
+            voltage = 0.0 if voltage < 0 else (self.max_voltage if voltage > self.max_voltage else voltage)
+            codes[channel] = ul.from_eng_units(self.board_num, self.range, voltage)
+        ul.a_out_scan(self.board_num, 0, number_of_channels - 1, number_of_channels, 100, self.range, self.analog_out_buffer, ScanOptions.SIMULTANEOUS)
+
     def set_digital_out(self, value, port):
-        ul.d_config_port(self.board_num, self.port_type, DigitalIODirection.OUT)
         ul.d_bit_out(self.board_num, port_type=self.port_type, bit_num=port, bit_value=value)
\ No newline at end of file
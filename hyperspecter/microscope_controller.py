@@ -47,6 +47,8 @@ class MicroscopeController:
         self.acquiring = False
         self.galvos = None
         self.pmts = None
+        self.process_frame = self.process_sawtooth_frame # processes a raw scan into an image, chosen for the scan pattern when configuring
+        self.galvo_buffer = None # [x_data, y_data] write buffer reused between configurations, grown as needed
 
     def __del__(self):
         if self.galvos and self.galvos.task: self.galvos.clear()
@@ -96,8 +98,9 @@ class MicroscopeController:
             )
 
 
-        write_data = np.concatenate((x_data, y_data))
-        
+        # Select the frame processing for the scan pattern once, rather than checking the pattern every frame
+        self.process_frame = self.process_bidirectional_frame if self.scan_pattern == 'bidirectional' else self.process_sawtooth_frame
+
         self.clock_rate = round(1000*self.samples_per_line/self.line_dwell_time)
         self.read_samples = self.samples_per_line * self.resolution + sum(self.padding)
 
@@ -124,6 +127,12 @@ class MicroscopeController:
         )
 
         # self.number_of_channels = self.pmts.number_of_channels
+        samples = len(x_data)
+        if self.galvo_buffer is None or self.galvo_buffer.size < 2*samples:
+            self.galvo_buffer = np.empty(2*samples, dtype=np.float64)
+        write_data = self.galvo_buffer[:2*samples]
+        write_data[:samples] = x_data
+        write_data[samples:] = y_data
         self.galvos.write(write_data)
 
     def get_frame(self):
@@ -132,17 +141,35 @@ class MicroscopeController:
             Returns:
                 read_data: 3D numpy array containing image data of type [channel, y, x]
         '''
+        self.prepare_frame()
+        return self.read_frame()
+
+    def prepare_frame(self):
+        ''' Configures the tasks for a single image without starting the scan, so it can overlap with other setup (e.g. stage moves). 
+            Follow with read_frame.
+        '''
+        if not self.simulate:
+            self.__configure_microscope(mode='finite')
+
+    def read_frame(self):
+        ''' Scans and reads the single image configured by prepare_frame.
+
+            Returns:
+                read_data: 3D numpy array containing image data of type [channel, y, x]
+        '''
         if self.simulate:
             time.sleep(self.line_dwell_time/1000*self.resolution) # simulate work
-            return np.random.randn(self.number_of_channels, self.resolution, self.resolution)
+            return np.random.randn(self.number_of_channels, self.resolution, self.resolution).astype(np.float32)
         else:
-            self.__configure_microscope(mode='finite')
-            data = self.pmts.read(samples_per_channel=self.read_samples)
-            self.pmts.wait()
-            self.galvos.stop()
-            self.galvos.clear()
-            self.pmts.stop()
-            self.pmts.clear()
+            try:
+                data = self.pmts.read_raw(samples_per_channel=self.read_samples)
+                self.pmts.wait()
+            finally:
+                # Release the tasks even if the read failed
+                self.galvos.stop()
+                self.galvos.clear()
+                self.pmts.stop()
+                self.pmts.clear()
             
             frame = self.process_frame(data)
             
@@ -157,52 +184,63 @@ class MicroscopeController:
         '''
         self.acquiring = True
 
-        if self.simulate:
-            while self.acquiring:
-                try:
-                    time.sleep(self.line_dwell_time/1000*self.resolution) # simulate work
-                    frame = np.random.randn(self.number_of_channels, self.resolution, self.resolution)
-                    image_q.put(frame)
-                except KeyboardInterrupt:
-                    self.acquiring = False
-                    break
-        else:
-            self.__configure_microscope(mode='continuous')
-            while self.acquiring:
+        try:
+            if self.simulate:
+                while self.acquiring:
+                    try:
+                        time.sleep(self.line_dwell_time/1000*self.resolution) # simulate work
+                        frame = np.random.randn(self.number_of_channels, self.resolution, self.resolution).astype(np.float32)
+                        image_q.put(frame)
+                    except KeyboardInterrupt:
+                        self.acquiring = False
+                        break
+            else:
+                self.__configure_microscope(mode='continuous')
                 try:
-                    data = self.pmts.read(samples_per_channel=self.read_samples)
-                    
-                    frame = self.process_frame(data)
-                    
-                    image_q.put(frame)
-                except KeyboardInterrupt:
-                    self.acquiring = False
-                    break
-            self.galvos.stop()
-            self.galvos.clear()
-            self.pmts.stop()
-            self.pmts.clear()
-
-        image_q.put(None) # sentinel value
-
-    def process_frame(self, raw_data):
-        frame = [[] for _ in range(self.pmts.number_of_channels)]
-        for channel, channel_data in enumerate(raw_data):
-            channel_data = channel_data[self.start_wait+self.delay:] # shift data to account for start wait and delay
-            frame[channel] = np.array_split(channel_data, self.resolution) # separates image channel data into 2D list of arrays
-
-            # Account for fill fraction
-            for line, line_data in enumerate(frame[channel]):
-                start = self.throwaway
-                stop = start + self.resolution
-                frame[channel][line] = line_data[start:stop]
-                
-            if self.scan_pattern == 'bidirectional':
-                # Flip every other row
-                for i in range(1, self.resolution, 2):
-                    frame[channel][i] = np.flip(frame[channel][i])
-
-        return np.array(frame)
+                    while self.acquiring:
+                        try:
+                            data = self.pmts.read_raw(samples_per_channel=self.read_samples)
+                            
+                            frame = self.process_frame(data)
+                            
+                            image_q.put(frame)
+                        except KeyboardInterrupt:
+                            self.acquiring = False
+                            break
+                finally:
+                    # Release the tasks even if a read failed (e.g. a buffer overflow or stop() clearing the task mid-read)
+                    self.galvos.stop()
+                    self.galvos.clear()
+                    self.pmts.stop()
+                    self.pmts.clear()
+
+        finally:
+            # The consumer drains the bounded queue until this sentinel, so it must be sent however the loop ended
+            image_q.put(None) # sentinel value
+
+    def __crop_frame(self, raw_data):
+        ''' Cuts the raw int16 ADC codes of one scan into lines, keeps the imaged pixels of each line and converts them to volts.
+
+            Returns:
+                frame: 3D float32 numpy array containing image data of type [channel, y, x]
+        '''
+        shift = self.start_wait + self.delay # shift data to account for start wait and delay
+        lines = raw_data[:, shift:shift + self.samples_per_line*self.resolution].reshape(len(raw_data), self.resolution, self.samples_per_line) # [channel, line, sample] view
+
+        # Account for fill fraction. Only the kept pixels are scaled to volts, into a new array since the read buffer is overwritten by the next read.
+        start = self.throwaway
+        stop = start + self.resolution
+        return self.pmts.scale_raw(lines[:, :, start:stop], dtype=np.float32)
+
+    def process_sawtooth_frame(self, raw_data):
+        ''' Processes a sawtooth scan into an image. See __crop_frame. '''
+        return self.__crop_frame(raw_data)
+
+    def process_bidirectional_frame(self, raw_data):
+        ''' Processes a bidirectional scan into an image, flipping every other row. See __crop_frame. '''
+        frame = self.__crop_frame(raw_data)
+        frame[:, 1::2] = frame[:, 1::2, ::-1]
+        return frame
 
     def stop(self):
         self.acquiring = False
@@ -1,16 +1,49 @@
 import time
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition, Event
 
 from PyAPT import APTMotor
 
+
+def adaptive_wait(predicate, spin_budget=0.002, max_sleep=0.05, timeout=None, condition=None):
+    ''' Waits until predicate() is true. Checks it continuously for spin_budget seconds so fast events are seen within 
+        microseconds, then sleeps between checks with a backoff doubling up to max_sleep so long waits yield the CPU.
+        If a Condition is given, the sleeps wait on it instead, so a notify from whatever changes the predicate wakes the check.
+        Returns False if timeout (seconds) passed first.
+    '''
+    start = time.perf_counter()
+    while time.perf_counter() - start < spin_budget:
+        if predicate(): return True
+    backoff = 0.001
+    while True:
+        if condition is None:
+            if predicate(): return True
+            if timeout is not None and time.perf_counter() - start > timeout: return False
+            time.sleep(backoff)
+        else:
+            with condition: # check and wait under one hold of the lock so a notify can't slip in between them
+                if predicate(): return True
+                if timeout is not None and time.perf_counter() - start > timeout: return False
+                condition.wait(backoff)
+        backoff = min(2*backoff, max_sleep)
+
+
 class baseDevice(object):
     def __init__(self):
         self.motorLoaded = False
         self.stageUpdate = False
-        self.presetWidgets = [None for i in range(999)]
-        self.movePresetFunction = [None for i in range(999)]
+        self.presetWidgets = {}      # preset number -> preset widget
+        self.movePresetFunction = {} # preset number -> function moving the stage to that preset
         self.currentPosition = None
         self.simulating = False
+        self.positionUpdated = Condition() # notified whenever getPositionThread reads a new position
+        self.stopPositionUpdate = Event()  # set to stop getPositionThread without waiting out its poll interval
+        self.moveDone = Event()            # cleared while a verifyMoveStatus move is in progress
+        self.moveDone.set()
+        self.moveExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stage-move') # runs moves one at a time, in order
+        self.lastMove = None               # future of the most recently queued move; moves run in order so it finishes last
+        self.moveQueued = Event()          # set when a move is queued to wake an idle getPositionThread
+        self.pendingMoves = set()          # futures of queued or running moves, so Clear can cancel those not yet started
 
 
     def baseDeviceHasNumbers(self,inputString):
@@ -31,8 +64,7 @@ class baseDevice(object):
                 self.MoveAbs(pos)
             else:
                 self.currentPosition = pos
-        # exec("self.MovePreset%s = MoveFunction"%n)
-        exec("self.movePresetFunction[%i] = MoveFunction"%n)
+        self.movePresetFunction[n] = MoveFunction
         return MoveFunction
 
     def setWidgets(self,widgets):
@@ -41,7 +73,7 @@ class baseDevice(object):
             if 'start' in widgetName :  self.StartPos = widget
             if 'end' in widgetName : self.EndPos = widget
             if ('move' in widgetName) or ('offset' in widgetName) : self.MoveDef = widget
-            if 'current' and 'position' in widgetName : self.currentStagePositionText = widget
+            if ('current' in widgetName) and ('position' in widgetName) : self.currentStagePositionText = widget
             if 'preset' in widgetName :
                 if self.baseDeviceHasNumbers(widgetName) :
                     n = self.baseDeviceGetNumber(widgetName)
@@ -55,22 +87,46 @@ class baseDevice(object):
     def verifyMoveStatus(self,function,*args):
         def changeBool(*args):
             self.positionStageOK = False
+            self.moveDone.clear()
             try : function(*args)
             except : function
             self.positionStageOK = True
+            self.moveDone.set()
         return changeBool
 
-    def threadThis(self, function, args=(), name=None):
-        thread = Thread(target=function, args=args, name=name)
-        thread.daemon = False
-        thread.start()
+    def threadThis(self, function, args=()):
+        ''' Queues function on the stage's move worker and returns its future. '''
+        if function is None: return None
+        self.lastMove = self.moveExecutor.submit(function, *args)
+        self.moveQueued.set()
+        self.pendingMoves.add(self.lastMove)
+        self.lastMove.add_done_callback(self.__moveFinished)
+        return self.lastMove
+
+    def __moveFinished(self, move):
+        self.pendingMoves.discard(move)
+        self.moveQueued.set() # one more position read once the move has finished
 
     def getPositionThread(self):
         if self.stageUpdate:
             print('Get position thread started...')
-        while self.stageUpdate:
-            time.sleep(0.05)
+        while self.stageUpdate and not self.stopPositionUpdate.is_set():
+            self.moveQueued.clear() # cleared before reading so a move queued or finished during the read still wakes the wait below
             self.currentPosition = self.GetPos()
+            with self.positionUpdated:
+                self.positionUpdated.notify_all()
+            if (self.lastMove is None) or self.lastMove.done():
+                # Stage idle: only re-read every 0.5 s (catches manual moves) unless a move is queued or finishes first
+                self.moveQueued.wait(0.5)
+            else:
+                self.stopPositionUpdate.wait(0.05)
+
+    def waitForPosition(self, position, timeout=None):
+        ''' Blocks until the stage is within 1e-5 of position, checking the position kept by getPositionThread with adaptive_wait.
+            Returns False if timeout (seconds) passed first.
+        '''
+        # Only getPositionThread talks to the stage, so waiting adds no USB traffic or concurrent APT DLL calls
+        return adaptive_wait(lambda: abs(self.currentPosition - position) <= 1e-5, timeout=timeout, condition=self.positionUpdated)
 
     def simulateStageMotion(self):
         dt = 0.1
@@ -110,7 +166,9 @@ class LStage(baseDevice):
         if widgets is not None :
             self.setWidgets(widgets)
         self.stageUpdate = True
-        self.threadThis(self.getPositionThread, name='getPositionThread')
+        # The position poll runs for the lifetime of the stage so it gets its own thread instead of blocking the move worker
+        self.positionThread = Thread(target=self.getPositionThread, name='getPositionThread', daemon=True)
+        self.positionThread.start()
         self.positionStageOK = True
         self.targetPosition = self.currentPosition
         self.endScanPosition = None
@@ -161,16 +219,18 @@ class LStage(baseDevice):
         self.moveType = moveType
 
     def SetStartPosition(self):
+        # Read the target once so the move and the wait agree even if the widget is edited mid-move
+        target = float(self.StartPos.value())
+        moveType = self.moveType.lower()
         self.Stop()
         time.sleep(0.1)
         if self.motorLoaded:
-            if ('none' not in self.moveType.lower()):
-                self.threadThis(self.MoveAbs(float(self.StartPos.value())))
-                while abs(self.currentPosition - float(self.StartPos.value())) > 1e-5 :
-                    time.sleep(0.1)
+            if ('none' not in moveType):
+                self.threadThis(self.MoveAbs(target))
+                self.waitForPosition(target)
         else :
-            if ('none' not in self.moveType.lower()):
-                self.currentPosition = float(self.StartPos.value())
+            if ('none' not in moveType):
+                self.currentPosition = target
                 self.positionStageOK = True
 
         self.endScanPosition = self.EndPos.value()
@@ -178,16 +238,16 @@ class LStage(baseDevice):
         # self.signal.setStartPositionDone.emit()
 
     def SetStartScan(self):
+        moveType = self.moveType.lower()
         if self.motorLoaded:
-            if 'continuous' in self.moveType.lower():
+            if 'continuous' in moveType:
                 self.threadThis(self.MoveAbs(self.EndPos.value(),self.MoveDef.value()))
-            if 'discrete' in self.moveType.lower():
+            if 'discrete' in moveType:
                 self.threadThis(self.MoveAbs(self.currentPosition + self.MoveDef.value()))
         else :
             self.simulating = True
             self.threadThis(self.simulateStageMotion)
-        while not self.positionStageOK :
-            time.sleep(0.1)
+        self.moveDone.wait()
 
     def SetSpeed(self,maxVel=10,minVel=0,acc=10):
         if self.motorLoaded :
@@ -202,9 +262,18 @@ class LStage(baseDevice):
             self.simulating = False
 
     def Clear(self):
+        self.stageUpdate = False
+        self.stopPositionUpdate.set() # wakes getPositionThread immediately
+        self.moveQueued.set()
+        for move in list(self.pendingMoves):
+            move.cancel() # only cancels moves that haven't started, like shutdown(cancel_futures=True) which needs Python 3.9
+        self.moveExecutor.shutdown(wait=False)
         try : self.motor.aptdll.cleanUpAPT()
         except : pass
 
+    def __del__(self):
+        self.moveExecutor.shutdown(wait=False)
+
 
 
 if __name__ == '__main__':
@@ -1,11 +1,19 @@
 ''' Utility classes/functions
 '''
 import configparser
+import io
 import os
 
 import tifffile as tf
 import numpy as np
 
+try:
+    from numba import njit, prange
+    numba_loaded = True
+except:
+    numba_loaded = False
+    print('Numba failed to load. Generating scan waveforms with NumPy.')
+
 
 
 
@@ -21,20 +29,35 @@ def gaussian(x,A=1,x0=0,sigma=1):
     y = A*np.exp(-((x-x0)**2)/(2*sigma**2))
     return y
 
-def scale_min_max(array, minimum=None, maximum=None):
-    ''' Scales data in array to range [0,1] where the minimum and maximum becomes 0 and 1, respectively. '''
-    x = np.array(array, copy=True)
-    mi = minimum if minimum else x.min()
-    ma = maximum if maximum else x.max()
-    return np.clip((x - mi)/(ma - mi), 0, 1)
+def horner(coefficients, x):
+    ''' Evaluates the polynomial with coefficients (highest power first, as in np.polyval) at x using Horner's method. 
+        For the short calibration polynomials this is a couple of plain multiply-adds, without np.polyval's overhead.
+    '''
+    y = 0
+    for coefficient in coefficients:
+        y = y*x + coefficient
+    return y
+
+def scale_min_max(array, minimum=None, maximum=None, scale=1.0, dtype=np.float64):
+    ''' Scales data in array to range [0,scale] where the minimum and maximum becomes 0 and scale, respectively. 
+        minimum and maximum default to the range of array and may also be arrays that broadcast against it, 
+        e.g. per channel levels of shape [channel, 1, 1]. The result is computed in a single new dtype array in place.
+    '''
+    array = np.asarray(array)
+    mi = array.min() if minimum is None else minimum
+    ma = array.max() if maximum is None else maximum
+    x = np.subtract(array, mi, dtype=dtype)
+    np.multiply(x, scale/(ma - mi), out=x)
+    np.clip(x, 0, scale, out=x)
+    return x
 
 def convert_to_16_bit(array, minimum=None, maximum=None):
-    a = scale_min_max(array, minimum, maximum) * 2**16
-    return a.astype(np.uint16)
+    ''' Maps array from [minimum, maximum] (defaulting to its own range) to the full uint16 range [0, 65535]. See scale_min_max. '''
+    return scale_min_max(array, minimum, maximum, scale=65535, dtype=np.float32).astype(np.uint16)
 
 def convert_to_8_bit(array, minimum=None, maximum=None):
-    a = scale_min_max(array, minimum, maximum) * 2**8
-    return a.astype(np.uint8)
+    ''' Maps array from [minimum, maximum] (defaulting to its own range) to the full uint8 range [0, 255]. See scale_min_max. '''
+    return scale_min_max(array, minimum, maximum, scale=255, dtype=np.float32).astype(np.uint8)
 
 
 
@@ -49,22 +72,67 @@ def convert_to_8_bit(array, minimum=None, maximum=None):
 
 def sawtooth(pixels: int, samples_per_pixel=1, number_of_lines=1):
     ''' Generates 'number_of_lines' linear ramps with 'pixels' values between -1 and 1. Each value is repeated 'samples_per_pixel' times. '''
-    result = np.linspace(-1, 1, pixels)
-    result = np.repeat(result, samples_per_pixel)
-    result = np.tile(result, number_of_lines)
-    return result
+    result = np.empty((number_of_lines, pixels, samples_per_pixel))
+    result[:] = np.linspace(-1, 1, pixels)[:, None] # broadcast the ramp over lines and samples in one pass
+    return result.reshape(-1)
 
 def triangle(pixels: int, samples_per_pixel=1, number_of_lines=1):
     ''' Takes the sawtooth wave and inverts every linear ramp. '''
     result = sawtooth(pixels, samples_per_pixel, number_of_lines)
-    width = pixels * samples_per_pixel
-    for i in range(1, number_of_lines, 2):
-        start = i * width
-        end = start + width
-        # result[start:end] = [1-value for value in result[start:end]]
-        result[start:end] = np.flip(result[start:end])
+    lines = result.reshape(number_of_lines, pixels * samples_per_pixel) # view of the result, one row per line
+    lines[1::2] = lines[1::2, ::-1]
     return result
 
+if numba_loaded:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def build_scan_waveforms(x_line, y_levels, reverse_odd_lines, padding_start, padding_end):
+        ''' Builds the clipped and padded x- and y-axis waveforms of a raster scan in a single pass, filling lines in parallel.
+            Each line repeats x_line (reversed on odd lines if reverse_odd_lines) while y is held at that line's y level.
+        '''
+        samples_per_line = x_line.size
+        lines = y_levels.size
+        end = padding_start + samples_per_line*lines
+        x_data = np.empty(end + padding_end)
+        y_data = np.empty(end + padding_end)
+        for line in prange(lines):
+            reverse = reverse_odd_lines and line % 2 == 1
+            y_value = min(max(y_levels[line], -10.0), 10.0)
+            start = padding_start + line*samples_per_line
+            for i in range(samples_per_line):
+                x_value = x_line[samples_per_line - 1 - i] if reverse else x_line[i]
+                x_data[start + i] = min(max(x_value, -10.0), 10.0)
+                y_data[start + i] = y_value
+        x_data[:padding_start] = x_data[padding_start]
+        y_data[:padding_start] = y_data[padding_start]
+        x_data[end:] = x_data[end - 1]
+        y_data[end:] = y_data[end - 1]
+        return x_data, y_data
+
+else:
+    def build_scan_waveforms(x_line, y_levels, reverse_odd_lines, padding_start, padding_end):
+        ''' Builds the clipped and padded x- and y-axis waveforms of a raster scan directly into the final buffers.
+            Each line repeats x_line (reversed on odd lines if reverse_odd_lines) while y is held at that line's y level.
+        '''
+        samples_per_line = x_line.size
+        lines = y_levels.size
+        end = padding_start + samples_per_line*lines
+        x_data = np.empty(end + padding_end)
+        y_data = np.empty(end + padding_end)
+
+        # Clip the single line and the y levels once, then broadcast them over every line in place
+        x_lines = x_data[padding_start:end].reshape(lines, samples_per_line)
+        x_lines[:] = np.clip(x_line, -10, 10)
+        if reverse_odd_lines:
+            x_lines[1::2] = x_lines[1::2, ::-1]
+        y_data[padding_start:end].reshape(lines, samples_per_line)[:] = np.clip(y_levels, -10, 10)[:, None]
+
+        x_data[:padding_start] = x_data[padding_start]
+        y_data[:padding_start] = y_data[padding_start]
+        x_data[end:] = x_data[end - 1]
+        y_data[end:] = y_data[end - 1]
+        return x_data, y_data
+
+
 def generate_sawtooth_scan(resolution=(256,256), amplitude=10, offset=(0,0), fill_fraction=1.0, flyback=0, padding=(0,0)):
     ''' Generates the x- and y-axis control waveforms in the sawtooth pattern.
     
@@ -100,22 +168,15 @@ def generate_sawtooth_scan(resolution=(256,256), amplitude=10, offset=(0,0), fil
     total_amplitude = amplitude / fill_fraction
     ff_offset = (1-fill_fraction) * total_amplitude
     total_offset = ff_offset + offset[0]
-    x_scan = total_amplitude * sawtooth(total_scan) - total_offset
-    x_flyback = generate_flyback(total_amplitude, total_offset, flyback)
-    x_data = np.tile(np.concatenate([x_scan, x_flyback]), resolution[1])
-    
-    # Create y-axis waveform
-    y_data = amplitude * sawtooth(resolution[1], samples_per_line) - offset[1]
+    x_line = np.empty(samples_per_line)
+    x_line[:total_scan] = total_amplitude * sawtooth(total_scan) - total_offset
+    generate_flyback(total_amplitude, total_offset, flyback, out=x_line[total_scan:])
 
-    assert x_data.size == y_data.size, 'X and Y should have the same size.'
-    
-    # Clip data outside of the -10V to +10V range allowed by the galvos
-    x_data = np.clip(x_data, -10, 10)
-    y_data = np.clip(y_data, -10, 10)
+    # Create y-axis waveform
+    y_levels = amplitude * sawtooth(resolution[1]) - offset[1]
 
-    # Add padding at start and end of waveforms
-    x_data = np.concatenate((np.full(padding[0],x_data[0]), x_data, np.full(padding[1],x_data[-1])))
-    y_data = np.concatenate((np.full(padding[0],y_data[0]), y_data, np.full(padding[1],y_data[-1])))
+    # Repeat the lines, clip data outside of the -10V to +10V range allowed by the galvos and add padding at start and end of waveforms
+    x_data, y_data = build_scan_waveforms(x_line, y_levels, False, padding[0], padding[1])
     
     return x_data, y_data, samples_per_line, throwaway, flyback, padding
 
@@ -151,29 +212,25 @@ def generate_bidirectional_scan(resolution=(256,256), amplitude=10, offset=(0,0)
     
     # Create x-axis waveform
     total_amplitude = amplitude / fill_fraction
-    x_data = total_amplitude * triangle(total_scan, 1, resolution[1]) - offset[0]
+    x_line = total_amplitude * sawtooth(total_scan) - offset[0] # reversed on every other line
     
     # Create y-axis waveform
-    y_data = amplitude * sawtooth(resolution[1], samples_per_line) - offset[1]
+    y_levels = amplitude * sawtooth(resolution[1]) - offset[1]
 
-    assert x_data.size == y_data.size, 'X and Y should have the same size.'
-    
-    # Clip data outside of the -10V to +10V range allowed by the galvos
-    x_data = np.clip(x_data, -10, 10)
-    y_data = np.clip(y_data, -10, 10)
-
-    # Add padding at start and end of waveforms
-    x_data = np.concatenate((np.full(padding[0],x_data[0]), x_data, np.full(padding[1],x_data[-1])))
-    y_data = np.concatenate((np.full(padding[0],y_data[0]), y_data, np.full(padding[1],y_data[-1])))
+    # Repeat the lines, clip data outside of the -10V to +10V range allowed by the galvos and add padding at start and end of waveforms
+    x_data, y_data = build_scan_waveforms(x_line, y_levels, True, padding[0], padding[1])
     
     return x_data, y_data, samples_per_line, throwaway, padding
 
 
-
-def generate_flyback(amplitude=10, offset=0, pixels=256):
-    x = np.linspace(0, np.pi, pixels)
-    flyback = amplitude * np.cos(x) - offset
-    return flyback
+def generate_flyback(amplitude=10, offset=0, pixels=256, out=None):
+    ''' Half-cosine flyback from +amplitude back to -amplitude, written into out if given. '''
+    if out is None:
+        out = np.empty(pixels)
+    np.cos(np.linspace(0, np.pi, pixels), out=out)
+    out *= amplitude
+    out -= offset
+    return out
 
 
 def estimate_imaging_time(start, stop, step_size, frame_time=1.28):
@@ -196,9 +253,9 @@ def estimate_imaging_time(start, stop, step_size, frame_time=1.28):
 #############################
 
 def save_settings(fname, settings):
+    text = ''.join(f'{k} = {v}\n' for k, v in settings.items()) # build the whole file in memory and write it once
     with open(fname, 'w') as file:
-        for k, v in settings.items():
-            file.write(f'{k} = {v}\n')
+        file.write(text)
 
 def save_config(fname, config):
     ''' Save a dictionary as a config file. '''
@@ -209,20 +266,16 @@ def save_config(fname, config):
         for key, val in config[section].items():
             parser.set(str(section), str(key), str(val))
     
+    buffer = io.StringIO() # parser writes piece by piece, so collect it in memory and write the file once
+    parser.write(buffer)
     with open(fname, 'w') as config_file:
-        parser.write(config_file)
+        config_file.write(buffer.getvalue())
 
 def load_config(fname):
     parser = configparser.ConfigParser()
     parser.read(fname)
     
-    config = {}
-    for section in parser.sections():
-        config[section] = {}
-        for key, val in parser[section].items():
-            config[section][key] = val
-
-    return config
+    return {section: dict(parser[section]) for section in parser.sections()}
 
 
 
@@ -1,7 +1,6 @@
 import numpy as np
 import pyqtgraph as pg
-import matplotlib.pyplot as plt
-from scipy.signal import find_peaks
+from scipy.signal import fftconvolve
 from PyQt5 import QtWidgets, QtCore, QtGui
 
 import ADIO
@@ -35,12 +34,18 @@ class WaveformOptimizer:
         x_plot.addLegend()
         self.x_control_plot = x_plot.plot(pen='r', name="control")
         self.x_actual_plot = x_plot.plot(pen='g', name="actual")
+        self.x_shifted_plot = x_plot.plot(pen=pg.mkPen((255,0,0,128), style=QtCore.Qt.DashLine), name="control + delay")
 
         y_plot = self.window.addPlot(row=1, col=1)
         y_plot.setMouseEnabled(x=False, y=False)
         y_plot.addLegend()
         self.y_control_plot = y_plot.plot(pen='r', name="control")
         self.y_actual_plot = y_plot.plot(pen='g', name="actual")
+
+        # Draw a min/max peak per pixel column instead of every sample of the full scan waveforms
+        for curve in (self.x_control_plot, self.x_actual_plot, self.x_shifted_plot, self.y_control_plot, self.y_actual_plot):
+            curve.setDownsampling(auto=True, method='peak')
+            curve.setClipToView(True)
         
 
     def configure_ADIO(self, mode='finite'):
@@ -74,8 +79,6 @@ class WaveformOptimizer:
 
         # x_scan = x_amplitude * utils.triangle(self.resolution, 1, self.number_of_lines) + x_offset
         # y_scan = y_amplitude * utils.sawtooth(self.resolution, self.number_of_lines, 1) + y_offset
-        
-        write_data = np.concatenate((x_scan, y_scan))
 
         self.x_control = x_scan
         self.y_control = y_scan
@@ -103,7 +106,7 @@ class WaveformOptimizer:
         )
 
         # self.number_of_channels = self.pmts.number_of_channels
-        self.output.write(write_data)
+        self.output.write_channels(x_scan, y_scan) # copied straight into the output's write buffer, no concatenated temporary
         
 
     def get_actual_waveform(self):
@@ -124,29 +127,20 @@ class WaveformOptimizer:
         self.y_control_plot.setData(self.y_control)
         self.y_actual_plot.setData(self.y_actual)
 
-    def get_delay(self):
-        # Get first peak of control waveform
-        control_peaks, _ = find_peaks(self.x_control, prominence=1)
-        control_peak = control_peaks[0]
-
-        # Get first peak of actual waveform
-        actual_peaks, _ = find_peaks(self.x_actual, prominence=1)
-        actual_peak = actual_peaks[0]
-
-        # Calculate difference
-        delay = actual_peak - control_peak
+    def get_delay(self, plot=False):
+        ''' Estimates how many samples the actual x waveform lags the control waveform from the peak of their cross-correlation. '''
+        # Cross-correlate the mean-subtracted waveforms in one FFT convolution; index len-1 corresponds to zero lag
+        control = self.x_control - self.x_control.mean()
+        actual = self.x_actual - self.x_actual.mean()
+        correlation = fftconvolve(actual, control[::-1], mode='full')
+        delay = int(correlation.argmax()) - (len(control) - 1)
         print(f'Delay: {delay} samples')
 
-        # Plot to verify peak locations
-        plt.figure()
-        plt.plot(self.x_control, 'r-')
-        plt.plot(control_peak, self.x_control[control_peak], 'rx')
-        plt.plot(self.x_actual, 'g-')
-        plt.plot(actual_peak, self.x_actual[actual_peak], 'gx')
-        plt.show()
+        if plot:
+            # Overlay the control waveform shifted by the delay to verify it lines up with the actual waveform
+            self.x_shifted_plot.setData(np.arange(len(self.x_control)) + delay, self.x_control)
 
         return delay
-
         
 
 if __name__ == '__main__':